@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# Compares the size and encode time of graph images in each image format.
+# usage: python3 -m benchmarks.bench_encoding [--entries 1000] [--encodes 20]
+
+import sys
+import time
+import argparse
+import statistics
+from typing import List, Tuple
+from benchmarks.bench_pipeline import synthetic_raffle
+from kipubot.encoding import ImageFormat, encode
+from kipubot.utils import GRAPH_YLABELS, FigureTemplate, downsample, parse_graph
+
+FORMATS: Tuple[Tuple[str, ImageFormat], ...] = (
+    ('png', ImageFormat()),
+    ('png level 1', ImageFormat(png_compression=1)),
+    ('png level 9', ImageFormat(png_compression=9)),
+    ('png 64 colors', ImageFormat(colors=64)),
+    ('png 16 colors', ImageFormat(colors=16)),
+    ('jpeg q85', ImageFormat(format='jpeg')),
+    ('webp q85', ImageFormat(format='webp')),
+    ('webp q60', ImageFormat(format='webp', quality=60)),
+    ('png 72 dpi', ImageFormat(dpi=72)),
+    ('png 16 colors 72 dpi', ImageFormat(colors=16, dpi=72)),
+    ('webp q85 72 dpi', ImageFormat(format='webp', dpi=72)),
+)
+
+
+def time_encodes(fmt: ImageFormat, entries: int, encodes: int) -> Tuple[int, float]:
+    # size of the image and the median encode time, drawing the figure included
+    raffle_data, _ = synthetic_raffle(entries)
+    x, pool = parse_graph(raffle_data)
+
+    template = FigureTemplate(GRAPH_YLABELS['graph'], fmt)
+    template.ax.plot(*downsample(template.fig, x, pool), 'r', marker='o', label='Pool')
+    template.ax.set_title('Benchmark')
+    template.ax.legend()
+
+    times: List[float] = []
+    for _ in range(encodes):
+        start = time.perf_counter()
+        img = encode(template.fig, fmt)
+        times.append(time.perf_counter() - start)
+
+    return len(img), statistics.median(times)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Benchmark graph image formats.')
+    parser.add_argument('--entries', type=int, default=1_000,
+                        help='entries in the plotted raffle')
+    parser.add_argument('--encodes', type=int, default=20,
+                        help='encodes to take the median of')
+    args = parser.parse_args()
+
+    print(f'{"format":<24}{"bytes":>10}{"encode ms":>12}')
+
+    for name, fmt in FORMATS:
+        size, seconds = time_encodes(fmt, args.entries, args.encodes)
+        print(f'{name:<24}{size:>10}{seconds * 1000:>12.2f}')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+# Times each stage of the raffle analytics and rendering pipeline on synthetic
+# raffles, and compares the results with a stored baseline.
+# usage: python3 -m benchmarks.bench_pipeline [--sizes 10 1000] [--save-baseline]
+#
+# No Telegram connection is needed. The DB round trip is timed against the
+# Postgres in DATABASE_URL, and skipped with --no-db.
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import tempfile
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+import numpy as np
+import pandas as pd
+from openpyxl import Workbook
+from kipubot import DATABASE_URL
+from kipubot.utils import (RaffleData, read_excel_to_df, parse_expected, parse_graph,
+                           fit_timedata, generate_graph, generate_expected,
+                           get_cur_time_hel, get_raffle, save_raffle)
+from kipubot.raffle import entries_from_df
+from kipubot import db
+
+SIZES = (10, 100, 1_000, 10_000, 100_000, 1_000_000)
+# writing and parsing huge exports takes minutes, so they're skipped by default
+MAX_EXCEL_SIZE = 100_000
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+# chat used for the DB round trip, Telegram never uses 0 as a chat id
+BENCH_CHAT_ID = 0
+
+# stage -> size -> seconds
+Results = Dict[str, Dict[str, float]]
+
+
+def synthetic_raffle(n: int, seed: int = 0) -> Tuple[RaffleData, pd.DataFrame]:
+    # a live raffle with n entries from about n/2 entrants,
+    # started five days ago and ending in five days
+    rng = np.random.default_rng(seed)
+    now = get_cur_time_hel().floor('D')
+    start_date = now - pd.Timedelta(days=5)
+    end_date = now + pd.Timedelta(days=5)
+
+    offsets = np.sort(rng.integers(0, (now - start_date).value, size=n))
+    df = pd.DataFrame({
+        'date': start_date + pd.to_timedelta(offsets, unit='ns'),
+        'name': [f'Entrant {i}' for i in rng.integers(0, max(n // 2, 1), size=n)],
+        'amount': rng.integers(1, 5, size=n) * 100
+    })
+
+    return RaffleData(start_date, end_date, 100, entries_from_df(df, 100)), df
+
+
+def write_excel(df: pd.DataFrame, path: str) -> None:
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    # exports list the newest entries first, amounts in euros
+    for date, name, amount in reversed(list(df.itertuples(index=False))):
+        ws.append((date.to_pydatetime(), name, 'Tipu', amount / 100))
+    wb.save(path)
+
+
+def time_stage(func: Callable[[], None], repeat: int = 3) -> float:
+    # best of repeat runs
+    best = float('inf')
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+
+    return best
+
+
+def bench_size(n: int, max_excel_size: int, use_db: bool) -> Dict[str, float]:
+    raffle_data, df = synthetic_raffle(n)
+    repeat = 3 if n <= 100_000 else 1
+    stages: Dict[str, float] = {}
+
+    if n <= max_excel_size:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            excel_path = os.path.join(tmp_dir, 'export.xlsx')
+            write_excel(df, excel_path)
+            stages['read_excel_to_df'] = time_stage(
+                lambda: read_excel_to_df(excel_path, raffle_data.start_date,
+                                         raffle_data.end_date),
+                repeat=repeat)
+
+    stages['entries_from_df'] = time_stage(
+        lambda: entries_from_df(df, raffle_data.entry_fee), repeat=repeat)
+    stages['parse_expected'] = time_stage(
+        lambda: parse_expected(raffle_data), repeat=repeat)
+    stages['parse_graph'] = time_stage(
+        lambda: parse_graph(raffle_data), repeat=repeat)
+
+    x, pool = parse_graph(raffle_data)
+    stages['fit_timedata'] = time_stage(
+        lambda: fit_timedata(x, pool), repeat=repeat)
+
+    stages['generate_graph'] = time_stage(
+        lambda: generate_graph(raffle_data, 'Benchmark'), repeat=repeat)
+    stages['generate_expected'] = time_stage(
+        lambda: generate_expected(raffle_data, 'Benchmark'), repeat=repeat)
+
+    if use_db:
+        stages.update(asyncio.run(bench_db(raffle_data, df, repeat)))
+
+    return stages
+
+
+async def bench_db(raffle_data: RaffleData, df: pd.DataFrame, repeat: int) -> Dict[str, float]:
+    start_date, end_date, entry_fee, _ = raffle_data
+    save_s, get_s = float('inf'), float('inf')
+
+    await db.open_pool(DATABASE_URL)
+    await db.save_chat_or_ignore(BENCH_CHAT_ID, 'Benchmark', [])
+
+    try:
+        for _ in range(repeat):
+            # so the previous run doesn't get archived as a past raffle
+            await db.delete_raffle_data(BENCH_CHAT_ID)
+            start = time.perf_counter()
+            await save_raffle(BENCH_CHAT_ID, start_date, end_date, entry_fee, df)
+            save_s = min(save_s, time.perf_counter() - start)
+
+            start = time.perf_counter()
+            await get_raffle(BENCH_CHAT_ID, include_entries=True)
+            get_s = min(get_s, time.perf_counter() - start)
+    finally:
+        await db.delete_raffle_data(BENCH_CHAT_ID)
+        await db.delete_chat(BENCH_CHAT_ID)
+        await db.close_pool()
+
+    return {'save_raffle': save_s, 'get_raffle': get_s}
+
+
+def run(sizes: List[int], max_excel_size: int, use_db: bool) -> Results:
+    results: Results = {}
+
+    for n in sizes:
+        print(f'Benchmarking {n} entries...', file=sys.stderr)
+        for stage, seconds in bench_size(n, max_excel_size, use_db).items():
+            results.setdefault(stage, {})[str(n)] = seconds
+
+    return results
+
+
+def machine_meta() -> Dict[str, object]:
+    return {
+        'date': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count()
+    }
+
+
+def mismatched_meta(baseline_meta: Dict[str, object], meta: Dict[str, object]) -> List[str]:
+    # timings of another python minor version or number of CPUs don't compare
+    def comparable(key: str, value: object) -> object:
+        if key == 'python' and isinstance(value, str):
+            return '.'.join(value.split('.')[:2])
+        return value
+
+    return [f'{key} ({baseline_meta.get(key)} vs {meta[key]})'
+            for key in ('python', 'cpu_count')
+            if comparable(key, baseline_meta.get(key)) != comparable(key, meta[key])]
+
+
+def compare(results: Results, baseline: Results, threshold: float,
+            min_delta: float) -> List[str]:
+    # slowdowns under min_delta seconds are noise, however large the ratio
+    regressions = []
+
+    for stage, sizes in results.items():
+        for size, seconds in sizes.items():
+            base_seconds = baseline.get(stage, {}).get(size)
+            if (base_seconds and seconds > base_seconds * threshold
+                    and seconds - base_seconds >= min_delta):
+                regressions.append(f'{stage} @ {size}: {base_seconds * 1000:.2f} ms -> '
+                                   f'{seconds * 1000:.2f} ms ({seconds / base_seconds:.2f}x)')
+
+    return regressions
+
+
+def print_table(results: Results, baseline: Optional[Results]) -> None:
+    sizes = sorted({size for stage in results.values() for size in stage}, key=int)
+    print(f'{"stage":<20}' + ''.join(f'{size:>14}' for size in sizes) + '   (ms)')
+
+    for stage, stage_results in results.items():
+        row = f'{stage:<20}'
+        for size in sizes:
+            seconds = stage_results.get(size)
+            base_seconds = (baseline or {}).get(stage, {}).get(size)
+            cell = '-' if seconds is None else f'{seconds * 1000:.2f}'
+            if seconds is not None and base_seconds:
+                cell += f' {seconds / base_seconds:.1f}x'
+            row += f'{cell:>14}'
+        print(row)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description='Benchmark the raffle analytics and rendering pipeline.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(SIZES),
+                        help='raffle sizes (entries) to benchmark')
+    parser.add_argument('--max-excel-size', type=int, default=MAX_EXCEL_SIZE,
+                        help='largest raffle to time read_excel_to_df with')
+    parser.add_argument('--no-db', action='store_true',
+                        help="don't time the database round trip")
+    parser.add_argument('--output', default='bench_results.json',
+                        help='where to write the results as JSON')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE,
+                        help='baseline results to compare with')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store the results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='slowdown factor over the baseline that counts as a regression')
+    parser.add_argument('--min-delta-ms', type=float, default=5,
+                        help='slowdowns smaller than this many milliseconds are ignored')
+    args = parser.parse_args()
+
+    results = run(args.sizes, args.max_excel_size, not args.no_db)
+
+    report = {
+        'meta': machine_meta(),
+        'results': results
+    }
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+
+    baseline = None
+    baseline_meta: Dict[str, object] = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            stored = json.load(f)
+        baseline, baseline_meta = stored['results'], stored.get('meta', {})
+
+    print_table(results, baseline)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f'Saved baseline to {args.baseline}')
+        return 0
+
+    if baseline is None:
+        print(f'No baseline found at {args.baseline}, run with --save-baseline to store one')
+        return 0
+
+    regressions = compare(results, baseline, args.threshold, args.min_delta_ms / 1000)
+
+    mismatched = mismatched_meta(baseline_meta, report['meta'])
+    if mismatched:
+        print(f'Baseline was recorded with a different {", ".join(mismatched)}, '
+              'slowdowns are only warned about')
+        for regression in regressions:
+            print(f'WARNING {regression}')
+        return 0
+
+    for regression in regressions:
+        print(f'REGRESSION {regression}')
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
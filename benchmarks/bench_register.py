@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# Measures how many concurrent /moro registrations per second the database takes,
+# with registrations written one by one and in batches.
+# usage: python3 -m benchmarks.bench_register [--registrations 1000] [--batch-sizes 1 100]
+
+import sys
+import time
+import asyncio
+import argparse
+from typing import List
+import psycopg
+from kipubot import DATABASE_URL, db
+from benchmarks.bench_pipeline import BENCH_CHAT_ID
+
+# users of the benchmark get ids far from real ones
+BENCH_USER_ID = -10**12
+
+
+async def time_registrations(registrations: int, batch_size: int) -> float:
+    # seconds to register every user in the chat at once
+    db.registrations = db.RegistrationBatcher(batch_size, db.REGISTER_BATCH_DELAY_MS / 1000)
+    await db.save_chat_or_ignore(BENCH_CHAT_ID, 'Benchmark', [])
+
+    try:
+        start = time.perf_counter()
+        await asyncio.gather(*(db.register_user(BENCH_CHAT_ID, BENCH_USER_ID - i, None)
+                               for i in range(registrations)))
+        return time.perf_counter() - start
+    finally:
+        await db.delete_chat(BENCH_CHAT_ID)
+        async with await psycopg.AsyncConnection.connect(DATABASE_URL) as con:
+            await con.execute('DELETE FROM chat_user WHERE user_id <= %s', (BENCH_USER_ID,))
+
+
+async def bench(registrations: int, batch_sizes: List[int]) -> None:
+    await db.open_pool(DATABASE_URL)
+
+    try:
+        print(f'{"batch size":>10}{"seconds":>10}{"per second":>12}')
+        for batch_size in batch_sizes:
+            seconds = await time_registrations(registrations, batch_size)
+            print(f'{batch_size:>10}{seconds:>10.3f}{registrations / seconds:>12.0f}')
+    finally:
+        await db.close_pool()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Benchmark batched user registrations.')
+    parser.add_argument('--registrations', type=int, default=1_000,
+                        help='registrations made at once')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 10, 100],
+                        help='batch sizes to compare, 1 writes every registration alone')
+    args = parser.parse_args()
+
+    asyncio.run(bench(args.registrations, args.batch_sizes))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
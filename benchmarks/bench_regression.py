@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# Compares fit_timedata with the previous curve_fit + uncertainties implementation.
+# usage: python3 -m benchmarks.bench_regression
+
+import timeit
+from functools import partial
+import numpy as np
+import pandas as pd
+from scipy import stats
+from scipy.optimize import curve_fit
+import uncertainties as unc
+import uncertainties.unumpy as unp
+from kipubot.utils import fit_timedata, get_cur_time_hel
+
+SIZES = (10, 100, 1_000, 10_000)
+
+
+def synthetic_series(n: int, seed: int = 0):
+    # n entries over ten days, followed by the raffle end date,
+    # all in the past so the fit doesn't depend on the current time
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp('2022-08-01').value
+    end = pd.Timestamp('2022-08-12').value
+    dates = np.sort(rng.integers(start, end - 10**9, size=n))
+    amounts = rng.integers(1, 5, size=n) * 100
+
+    x_series = pd.Series(np.append(dates, end))
+    y_series = pd.Series(np.append(np.cumsum(amounts), 0))
+
+    return x_series, y_series
+
+
+def legacy_preband(x, xd, yd, p, func):
+    conf = 0.95
+    alpha = 1.0 - conf
+    quantile = stats.t.ppf(1.0 - alpha / 2.0, xd.size - len(p))
+    stdev = np.sqrt(1. / (xd.size - len(p)) * np.sum((yd - func(xd, *p))**2))
+    sx = (x - xd.mean()) ** 2
+    sxd = np.sum((xd - xd.mean()) ** 2)
+    yp = func(x, *p)
+    dy = quantile * stdev * np.sqrt(1.0 + 1.0 / xd.size + sx / sxd)
+    return yp - dy, yp + dy
+
+
+def legacy_fit_timedata(x_series, y_series):  # pylint: disable=too-many-locals
+    x = x_series.values[:-1]
+    y = y_series.values[:-1]
+
+    def f(x, slope, intercept):
+        return slope * x + intercept
+
+    # pylint: disable=unbalanced-tuple-unpacking
+    popt, pcov = curve_fit(f, x, y)
+    a, b = unc.correlated_values(popt, pcov)
+
+    now = get_cur_time_hel().value
+    end = x_series.iloc[-2] if now >= x_series.iloc[-1] else x_series.iloc[-1]
+
+    px = np.linspace(x_series.iloc[0], end, y_series.size - 1, dtype=np.int64)
+    py = a*px+b
+    nom = unp.nominal_values(py)
+    std = unp.std_devs(py)
+
+    lpb, upb = legacy_preband(px, x, y, popt, f)
+    px = [pd.to_datetime(x, unit='ns') for x in px]
+
+    return (px, nom, std, lpb, upb)
+
+
+def max_rel_diff(new, old) -> float:
+    new = np.asarray(new, dtype=np.float64)
+    old = np.asarray(old, dtype=np.float64)
+    return float(np.max(np.abs(new - old) / np.maximum(np.abs(old), 1.0)))
+
+
+def main() -> None:
+    print(f'{"entries":>8} {"legacy ms":>10} {"closed ms":>10} {"speedup":>8} {"max diff":>10}')
+
+    for n in SIZES:
+        x_series, y_series = synthetic_series(n)
+        number = max(1, 1_000 // n)
+
+        legacy_s = min(timeit.repeat(partial(legacy_fit_timedata, x_series, y_series),
+                                     number=number, repeat=3)) / number
+        # on the grid the legacy fit uses, one point per entry
+        grid_size = y_series.size - 1
+        closed_s = min(timeit.repeat(partial(fit_timedata, x_series, y_series, grid_size),
+                                     number=number, repeat=3)) / number
+
+        new = fit_timedata(x_series, y_series, grid_size)
+        old = legacy_fit_timedata(x_series, y_series)
+        diff = max(max_rel_diff(a, b) for a, b in zip(new[1:], old[1:]))
+
+        print(f'{n:>8} {legacy_s * 1000:>10.3f} {closed_s * 1000:>10.3f} '
+              f'{legacy_s / closed_s:>7.1f}x {diff:>10.2e}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# Compares rendering graphs on a freshly styled figure with reusing a figure template.
+# usage: python3 -m benchmarks.bench_render [--sizes 10 1000] [--renders 20]
+
+import sys
+import time
+import argparse
+import statistics
+from typing import Callable, List
+from benchmarks.bench_pipeline import synthetic_raffle
+from kipubot.utils import RaffleData, clear_figure_templates, generate_expected, generate_graph
+
+SIZES = (10, 1_000, 100_000)
+
+
+def time_renders(render: Callable[[RaffleData, str], bytes],
+                 raffle_data: RaffleData,
+                 renders: int,
+                 reuse: bool) -> float:
+    # median of the renders, clearing the templates isn't timed
+    times: List[float] = []
+
+    for _ in range(renders):
+        if not reuse:
+            clear_figure_templates()
+        start = time.perf_counter()
+        render(raffle_data, 'Benchmark')
+        times.append(time.perf_counter() - start)
+
+    return statistics.median(times)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description='Benchmark reusing figure templates between renders.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(SIZES),
+                        help='raffle sizes (entries) to benchmark')
+    parser.add_argument('--renders', type=int, default=20,
+                        help='renders to take the median of')
+    args = parser.parse_args()
+
+    print(f'{"graph":<10}{"entries":>10}{"fresh ms":>12}{"reused ms":>12}{"saved ms":>12}')
+
+    for n in args.sizes:
+        raffle_data, _ = synthetic_raffle(n)
+        for name, render in (('graph', generate_graph), ('expected', generate_expected)):
+            # warm up imports and caches of matplotlib
+            render(raffle_data, 'Benchmark')
+            fresh = time_renders(render, raffle_data, args.renders, reuse=False)
+            reused = time_renders(render, raffle_data, args.renders, reuse=True)
+            print(f'{name:<10}{n:>10}{fresh * 1000:>12.2f}{reused * 1000:>12.2f}'
+                  f'{(fresh - reused) * 1000:>12.2f}')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# Measures how long starting the bot takes to import, in fresh interpreters,
+# and which of the heavy analytics libraries get imported along the way.
+# usage: python3 -m benchmarks.bench_startup [--runs 10] [--budget 1.0]
+
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+HEAVY_MODULES = ('pandas', 'numpy', 'scipy', 'matplotlib', 'openpyxl')
+
+# lazily imported modules sit in sys.modules as placeholders until first used
+SNIPPET = '''
+import sys, json, time, types
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds,
+                  'heavy': [m for m in {heavy!r}
+                            if type(sys.modules.get(m)) is types.ModuleType]}}))
+'''
+
+
+def measure(module: str) -> dict:
+    start = time.perf_counter()
+    out = subprocess.run([sys.executable, '-c', SNIPPET.format(module=module, heavy=HEAVY_MODULES)],
+                         check=True, capture_output=True, text=True).stdout
+    result = json.loads(out.strip().splitlines()[-1])
+    result['process_seconds'] = time.perf_counter() - start
+    return result
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the import time of the bot.')
+    parser.add_argument('--module', default='kipubot.bot',
+                        help='module to import')
+    parser.add_argument('--runs', type=int, default=10,
+                        help='number of fresh interpreters to measure')
+    parser.add_argument('--budget', type=float, default=None,
+                        help='fail if the median import takes longer than this many seconds')
+    args = parser.parse_args()
+
+    results = [measure(args.module) for _ in range(args.runs)]
+    imports = [r['seconds'] for r in results]
+    processes = [r['process_seconds'] for r in results]
+
+    print(f'import {args.module}: median {statistics.median(imports) * 1000:.0f} ms, '
+          f'min {min(imports) * 1000:.0f} ms over {args.runs} runs')
+    print(f'whole process: median {statistics.median(processes) * 1000:.0f} ms')
+    print(f'heavy modules imported: {", ".join(results[0]["heavy"]) or "none"}')
+
+    if args.budget is not None and statistics.median(imports) > args.budget:
+        print(f'Over the budget of {args.budget * 1000:.0f} ms')
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
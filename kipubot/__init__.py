@@ -2,7 +2,6 @@ import os
 import sys
 import logging
 from dotenv import load_dotenv
-import kipubot.db
 
 load_dotenv()
 
@@ -29,15 +28,6 @@ if DATABASE_URL is None:
 if DEVELOPER_CHAT_ID is None:
     logging.warning('Developer chat ID is not set!')
 
-
-# INITIALIZE DB AND CREATE TABLES IF THEY DON'T EXIST
-kipubot.db._init_db(DATABASE_URL)  # pylint: disable=protected-access
-
-# CHECK/CREATE DATA DIRECTORY
-if not os.path.exists('data'):
-    logging.info('Creating ./data/ directory...')
-    os.mkdir('data')
-
 __all__ = (
     'BOT_TOKEN',
     'DATABASE_URL',
@@ -1,23 +1,80 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from telegram.ext import ApplicationBuilder, PicklePersistence
-from kipubot import BOT_TOKEN
+import os
+import signal
+import asyncio
+from telegram import Update
+from telegram.ext import Application, ApplicationBuilder
+from kipubot import BOT_TOKEN, DATABASE_URL
+from kipubot.db import open_pool
+from kipubot.persistence import PostgresPersistence
+from kipubot import profiling
+from kipubot.metrics import (METRICS_PORT, InstrumentedRequest, instrument,
+                             start_metrics_server)
 from kipubot.handlers import (start_handler, moro_handler, excel_file_handler,
                               bot_added_handler, winner_handler, graph_handler,
-                              expected_value_handler, raffle_setup_handler, no_dm_handler,
+                              expected_value_handler, history_handler, raffle_setup_handler,
+                              no_dm_handler, username_handler, member_update_handler,
                               error_handler)
 
+# serve updates from a webhook at this public URL instead of polling for them
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', default=None)
+# address, port and path the webhook server listens on
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', default='0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', default='8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', default='telegram')
+# requests without this X-Telegram-Bot-Api-Secret-Token header are rejected
+WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN', default=None)
+# simultaneous connections Telegram may open to the webhook
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', default='40'))
+
+
+async def post_init(_app: Application) -> None:
+    # the pool has to be opened inside the application's event loop,
+    # the first open also creates any missing tables
+    await open_pool(DATABASE_URL)
+
+    # kill -USR1 <pid> logs the DB profile gathered so far
+    if profiling.DB_PROFILE and hasattr(signal, 'SIGUSR1'):
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, profiling.log_report)
+
 
 def main() -> None:
-    persistence = PicklePersistence(filepath='data/.pkl')
-    app = (
+    persistence = PostgresPersistence(DATABASE_URL)
+    builder = (
         ApplicationBuilder()
         .token(BOT_TOKEN)
         .persistence(persistence)
-        .build()
+        .post_init(post_init)
     )
 
+    if METRICS_PORT:
+        # count Bot API calls, getUpdates has a request object of its own
+        builder = (
+            builder
+            .request(InstrumentedRequest(connection_pool_size=128))
+            .get_updates_request(InstrumentedRequest())
+        )
+
+        for handler, name in ((start_handler, 'start'),
+                              (bot_added_handler, 'bot_added'),
+                              (moro_handler, 'hello'),
+                              (graph_handler, 'graph'),
+                              (winner_handler, 'winner'),
+                              (expected_value_handler, 'expected'),
+                              (history_handler, 'history'),
+                              (excel_file_handler, 'excel_file'),
+                              (raffle_setup_handler, 'raffle_setup')):
+            instrument(handler, name)
+
+        start_metrics_server()
+
+    app = builder.build()
+
+    # update cached chat members before any other handler sees the update
+    app.add_handler(member_update_handler, group=-1)
+
     app.add_handler(start_handler)
 
     # added to channel
@@ -28,6 +85,7 @@ def main() -> None:
     app.add_handler(graph_handler)
     app.add_handler(winner_handler)
     app.add_handler(expected_value_handler)
+    app.add_handler(history_handler)
 
     # warning about using a command in a private chat
     app.add_handler(no_dm_handler)
@@ -38,7 +96,21 @@ def main() -> None:
     # start conversation after selecting channel from excel file
     app.add_handler(raffle_setup_handler)
 
+    # keep the username index up to date, in its own group
+    # so it sees every group message alongside the handlers above
+    app.add_handler(username_handler, group=1)
+
     # add error handler
     app.add_error_handler(error_handler)
 
-    app.run_polling()
+    # chat_member updates aren't sent unless asked for
+    if WEBHOOK_URL:
+        app.run_webhook(listen=WEBHOOK_LISTEN,
+                        port=WEBHOOK_PORT,
+                        url_path=WEBHOOK_PATH,
+                        webhook_url=WEBHOOK_URL,
+                        secret_token=WEBHOOK_SECRET_TOKEN,
+                        max_connections=WEBHOOK_MAX_CONNECTIONS,
+                        allowed_updates=Update.ALL_TYPES)
+    else:
+        app.run_polling(allowed_updates=Update.ALL_TYPES)
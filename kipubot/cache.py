@@ -0,0 +1,192 @@
+import os
+import time
+import asyncio
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+# rendered graphs are cached in memory up to this many bytes
+RENDER_CACHE_MAX_BYTES = int(os.getenv('RENDER_CACHE_MAX_BYTES', default=str(32 * 1024 * 1024)))
+# cached graphs are re-rendered at least this often as "now" moves on
+RENDER_CACHE_BUCKET_SECONDS = int(os.getenv('RENDER_CACHE_BUCKET_SECONDS', default='60'))
+# seconds Telegram chat member and administrator lookups are reused
+MEMBER_CACHE_TTL = float(os.getenv('MEMBER_CACHE_TTL', default='300'))
+# seconds a "User not found" lookup is reused
+MEMBER_CACHE_NEGATIVE_TTL = float(os.getenv('MEMBER_CACHE_NEGATIVE_TTL', default='60'))
+# number of cached member and administrator lookups
+MEMBER_CACHE_MAX_SIZE = int(os.getenv('MEMBER_CACHE_MAX_SIZE', default='10000'))
+# seconds a chat's admins and winners are reused, writes through the bot update them
+CHAT_STATE_CACHE_TTL = float(os.getenv('CHAT_STATE_CACHE_TTL', default='300'))
+# number of chats whose admins and winners are cached
+CHAT_STATE_CACHE_MAX_SIZE = int(os.getenv('CHAT_STATE_CACHE_MAX_SIZE', default='10000'))
+
+# returned by TTLCache.get on a miss, as None is a valid cached value
+MISSING = object()
+
+# (chat_id, graph_type, data_version, time_bucket)
+RenderKey = Tuple[int, str, int, int]
+
+
+class RenderCache:
+    """LRU cache of rendered graph images, bounded by total size in bytes.
+
+    A raffle's data version is bumped whenever its data changes, so entries
+    rendered from stale data are never matched again and age out of the LRU.
+    The Telegram file_id of a sent image is kept under the same key, so the
+    image can be sent again without uploading it. Concurrent misses of a key
+    share a single render.
+    """
+
+    def __init__(self, max_bytes: int, bucket_seconds: int) -> None:
+        self.max_bytes = max_bytes
+        self.bucket_seconds = max(bucket_seconds, 1)
+        self._entries: 'OrderedDict[RenderKey, bytes]' = OrderedDict()
+        self._versions: Dict[int, int] = {}
+        self._file_ids: Dict[RenderKey, str] = {}
+        self._rendering: Dict[RenderKey, 'asyncio.Future[bytes]'] = {}
+        self._size = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def key(self, chat_id: int, graph_type: str) -> RenderKey:
+        bucket = int(time.time() // self.bucket_seconds)
+        return (chat_id, graph_type, self._versions.get(chat_id, 0), bucket)
+
+    def get(self, key: RenderKey) -> Optional[bytes]:
+        img = self._entries.get(key)
+        if img is not None:
+            self._entries.move_to_end(key)
+        return img
+
+    def put(self, key: RenderKey, img: bytes) -> None:
+        if len(img) > self.max_bytes:
+            return
+
+        # older renders of the same graph can never be hit again
+        chat_id, graph_type, _, _ = key
+        for old_key in [k for k in self._entries if k[:2] == (chat_id, graph_type)]:
+            self._pop(old_key)
+
+        self._entries[key] = img
+        self._size += len(img)
+
+        while self._size > self.max_bytes:
+            self._pop(next(iter(self._entries)))
+
+    async def get_or_render(self, key: RenderKey,
+                            render: Callable[[], Awaitable[bytes]]) -> bytes:
+        img = self.get(key)
+        if img is not None:
+            return img
+
+        # a render of the key is already running, wait for its image or error
+        rendering = self._rendering.get(key)
+        if rendering is not None:
+            return await asyncio.shield(rendering)
+
+        rendering = asyncio.get_running_loop().create_future()
+        # the error is retrieved even if nobody else was waiting for it
+        rendering.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._rendering[key] = rendering
+        try:
+            img = await render()
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                rendering.cancel()
+            else:
+                rendering.set_exception(e)
+            raise
+        finally:
+            del self._rendering[key]
+
+        rendering.set_result(img)
+        self.put(key, img)
+        return img
+
+    def get_file_id(self, key: RenderKey) -> Optional[str]:
+        return self._file_ids.get(key)
+
+    def put_file_id(self, key: RenderKey, file_id: str) -> None:
+        # at most one file_id per graph, like the rendered images
+        chat_id, graph_type, _, _ = key
+        for old_key in [k for k in self._file_ids if k[:2] == (chat_id, graph_type)]:
+            del self._file_ids[old_key]
+
+        self._file_ids[key] = file_id
+
+    def forget_file_id(self, key: RenderKey) -> None:
+        self._file_ids.pop(key, None)
+
+    def invalidate(self, chat_id: int) -> None:
+        self._versions[chat_id] = self._versions.get(chat_id, 0) + 1
+        for old_key in [k for k in self._entries if k[0] == chat_id]:
+            self._pop(old_key)
+        for old_key in [k for k in self._file_ids if k[0] == chat_id]:
+            del self._file_ids[old_key]
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._versions.clear()
+        self._file_ids.clear()
+        self._size = 0
+
+    def _pop(self, key: RenderKey) -> None:
+        self._size -= len(self._entries.pop(key))
+
+
+class TTLCache:
+    """LRU cache bounded by number of entries, each of which expires after its TTL."""
+
+    def __init__(self, max_size: int, ttl: float,
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self._clock = clock
+        # key -> (expiry time, value)
+        self._entries: 'OrderedDict[Hashable, Tuple[float, Any]]' = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Any:
+        entry = self._entries.get(key)
+
+        if entry is None:
+            return MISSING
+
+        expires, value = entry
+        if expires <= self._clock():
+            del self._entries[key]
+            return MISSING
+
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        if self.max_size <= 0:
+            return
+
+        self._entries[key] = (self._clock() + (self.ttl if ttl is None else ttl), value)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+
+render_cache = RenderCache(RENDER_CACHE_MAX_BYTES, RENDER_CACHE_BUCKET_SECONDS)
+# (chat_id, user_id) -> ChatMember, or None if the user wasn't found
+member_cache = TTLCache(MEMBER_CACHE_MAX_SIZE, MEMBER_CACHE_TTL)
+# chat_id -> administrator ChatMembers
+admin_cache = TTLCache(MEMBER_CACHE_MAX_SIZE, MEMBER_CACHE_TTL)
+# chat_id -> ChatState
+chat_state_cache = TTLCache(CHAT_STATE_CACHE_MAX_SIZE, CHAT_STATE_CACHE_TTL)
@@ -11,7 +11,11 @@ STRINGS = {
     'raffle_db_error': ('Error getting raffle data from database!\n\n' +
                         'Perhaps one is not setup yet for this chat? 🤔'),
     'no_entries': 'No raffle entries yet in %(chat_title)s!',
-    'no_data': 'No data found for %(chat_title)s!',
+    'render_timeout': 'Drawing the graph took too long, please try again later! 🕐',
+    'no_history': 'No past raffles in %(chat_title)s!',
+    'history': '📜 Past raffles in %(chat_title)s\n\n',
+    'history_raffle': ('%(start_date)s - %(end_date)s (%(duration)s)\n' +
+                       'Pool %(pool)s € | Entrants %(entrants)d\n\n'),
     'moro': 'Registered %(username)s in %(chat_title)s!',
     'double_moro': 'You are already registered in %(chat_title)s!',
     'no_dm_warn': 'This command is not usable in private messages!',
@@ -28,7 +32,8 @@ STRINGS = {
                                    'Do you want update it or create a new one?'),
     'raffle_setup_new': ('No existing raffle found.\n' +
                          'Do you want to create a new one?'),
-    'updated_raffle': 'Updated raffle data in %(chat_title)s! 🔄',
+    'updated_raffle': ('Updated raffle data in %(chat_title)s! 🔄\n\n' +
+                       'Added %(new_entries)d new entries.'),
     'raffle_setup_start_date': 'Start date set to %(start_date)s!\n',
     'raffle_setup_end_date': 'End date set to %(end_date)s!\n\n',
     'raffle_setup_fee': 'Fee set to %(fee)s €!\n\n',
@@ -1,28 +1,68 @@
+import os
+import time
+import pickle
+import asyncio
 import logging
-from typing import Tuple, List, Optional
-from pandas import Timestamp, DataFrame
+from collections import Counter
+from functools import wraps
+from typing import (TYPE_CHECKING, Any, Awaitable, Callable, Dict, NamedTuple,
+                    Set, Tuple, List, Optional, TypeVar)
 import psycopg
 import psycopg.errors as PSErrors
-from kipubot.errors import AlreadyRegisteredError
-
-# STORE DB CONNECTION
-_CON: Optional[psycopg.Connection] = None
+from psycopg import sql
+from psycopg_pool import AsyncConnectionPool
+from kipubot.errors import AlreadyRegisteredError, NoRaffleError
+from kipubot.cache import MISSING, chat_state_cache, render_cache
+from kipubot import profiling
+from kipubot.lazy import lazy_import
+
+if TYPE_CHECKING:
+    from pandas import Timestamp, DataFrame
+    from kipubot.raffle import RaffleEntries, SeriesState
+
+# only needed by the raffle functions
+pd = lazy_import('pandas')
+raffle = lazy_import('kipubot.raffle')
+
+# minimum and maximum number of pooled DB connections
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', default='1'))
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', default='10'))
+# seconds a single DB call may take, including waiting for a free connection
+DB_TIMEOUT = float(os.getenv('DB_TIMEOUT', default='10'))
+# registrations are written together, in batches of at most this many
+# or after waiting this many milliseconds for more
+REGISTER_BATCH_SIZE = int(os.getenv('REGISTER_BATCH_SIZE', default='100'))
+REGISTER_BATCH_DELAY_MS = float(os.getenv('REGISTER_BATCH_DELAY_MS', default='5'))
+
+# STORE DB CONNECTION POOL
+_POOL: Optional[AsyncConnectionPool] = None
 
 # LOGGER
 _logger = logging.getLogger(__name__)
 
+T = TypeVar('T')
 
-def _init_db(url: str) -> None:
-    global _CON  # pylint: disable=global-statement
+# (date, name, amount)
+RaffleEntry = Tuple['Timestamp', str, int]
+
+
+class ChatState(NamedTuple):
+    admins: List[int]
+    prev_winners: List[int]
+    cur_winner: Optional[int]
 
-    if not _CON:
-        _logger.info('Connecting to DB...')
-        _CON = psycopg.connect(url)
-        _logger.info('Connected!')
+
+_CHAT_STATE_COLUMNS = 'admins, prev_winners, cur_winner'
+
+
+def _init_db(url: str) -> None:
+    _logger.info('Connecting to DB...')
+    con = psycopg.connect(url)
+    _logger.info('Connected!')
 
     _logger.info('Initializing database...')
     try:
-        _CON.execute('''CREATE TABLE IF NOT EXISTS chat (
+        con.execute('''CREATE TABLE IF NOT EXISTS chat (
                         chat_id BIGINT PRIMARY KEY,
                         title VARCHAR(128),
                         admins BIGINT[],
@@ -30,174 +70,791 @@ def _init_db(url: str) -> None:
                         cur_winner BIGINT
                     )''')
 
-        _CON.execute('''CREATE TABLE IF NOT EXISTS chat_user (
+        con.execute('''CREATE TABLE IF NOT EXISTS chat_user (
                         user_id BIGINT PRIMARY KEY
                     )''')
 
-        _CON.execute('''CREATE TABLE IF NOT EXISTS in_chat (
+        con.execute('''ALTER TABLE chat_user
+                        ADD COLUMN IF NOT EXISTS username VARCHAR(32)''')
+
+        # usernames are case-insensitive and held by one user at a time
+        con.execute('''CREATE UNIQUE INDEX IF NOT EXISTS chat_user_username_idx
+                        ON chat_user (lower(username))''')
+
+        con.execute('''CREATE TABLE IF NOT EXISTS in_chat (
                         user_id BIGINT REFERENCES chat_user(user_id),
                         chat_id BIGINT REFERENCES chat(chat_id),
                         PRIMARY KEY (user_id, chat_id)
                     )''')
 
-        _CON.execute('''CREATE TABLE IF NOT EXISTS raffle (
+        con.execute('''CREATE TABLE IF NOT EXISTS raffle (
                         chat_id BIGINT PRIMARY KEY REFERENCES chat(chat_id),
                         start_date TIMESTAMP,
                         end_date TIMESTAMP,
+                        entry_fee INTEGER
+                    )''')
+
+        con.execute('''CREATE TABLE IF NOT EXISTS raffle_entry (
+                        entry_id BIGSERIAL PRIMARY KEY,
+                        chat_id BIGINT REFERENCES raffle(chat_id) ON DELETE CASCADE,
+                        date TIMESTAMP,
+                        name VARCHAR(128),
+                        amount INTEGER
+                    )''')
+
+        con.execute('''CREATE INDEX IF NOT EXISTS raffle_entry_chat_id_date_idx
+                        ON raffle_entry (chat_id, date)''')
+
+        # series the graphs plot, derived from the entries up to and including each one
+        con.execute('''ALTER TABLE raffle_entry
+                        ADD COLUMN IF NOT EXISTS pool BIGINT,
+                        ADD COLUMN IF NOT EXISTS entrants INTEGER,
+                        ADD COLUMN IF NOT EXISTS win_odds DOUBLE PRECISION,
+                        ADD COLUMN IF NOT EXISTS next_expected BIGINT''')
+
+        # summaries of raffles replaced by a new one, newest first per chat
+        con.execute('''CREATE TABLE IF NOT EXISTS raffle_history (
+                        raffle_id BIGSERIAL PRIMARY KEY,
+                        chat_id BIGINT,
+                        start_date TIMESTAMP,
+                        end_date TIMESTAMP,
                         entry_fee INTEGER,
-                        dates TIMESTAMP[],
-                        entries VARCHAR(128)[],
-                        amounts INTEGER[]
+                        entries INTEGER,
+                        entrants INTEGER,
+                        pool BIGINT
+                    )''')
+
+        con.execute('''CREATE INDEX IF NOT EXISTS raffle_history_chat_id_end_date_idx
+                        ON raffle_history (chat_id, end_date)''')
+
+        # entries of past raffles, in yearly partitions made as raffles get archived,
+        # so the entries of live raffles stay in a table of their own
+        con.execute('''CREATE TABLE IF NOT EXISTS raffle_entry_archive (
+                        raffle_id BIGINT,
+                        date TIMESTAMP NOT NULL,
+                        name VARCHAR(128),
+                        amount INTEGER
+                    ) PARTITION BY RANGE (date)''')
+
+        con.execute('''CREATE INDEX IF NOT EXISTS raffle_entry_archive_raffle_id_idx
+                        ON raffle_entry_archive (raffle_id)''')
+
+        # pickled user and chat data of the bot's persistence
+        con.execute('''CREATE TABLE IF NOT EXISTS persistence_data (
+                        kind VARCHAR(16),
+                        id BIGINT,
+                        data BYTEA,
+                        PRIMARY KEY (kind, id)
                     )''')
+
+        con.execute('''CREATE TABLE IF NOT EXISTS conversation_state (
+                        name VARCHAR(64),
+                        key TEXT,
+                        state BYTEA,
+                        PRIMARY KEY (name, key)
+                    )''')
+
+        # one-time migrations that can't be told apart by the schema are recorded here
+        con.execute('''CREATE TABLE IF NOT EXISTS schema_migration (
+                        name VARCHAR(64) PRIMARY KEY
+                    )''')
+
+        _migrate_raffle_arrays(con)
+        _migrate_derived_series(con)
+        _migrate_empty_persistence_data(con)
     except PSErrors.Error as e:
         _logger.error('Unknown error during database initialization:')
         _logger.error(e)
-        _CON.rollback()
+        con.rollback()
     else:
         _logger.info('Database succesfully initialized!')
-        _CON.commit()
+        con.commit()
+    finally:
+        con.close()
+
+
+def _first_run(con: psycopg.Connection, migration: str) -> bool:
+    # records the migration as run, in the transaction running it
+    return con.execute('''INSERT INTO schema_migration (name) VALUES (%s)
+                            ON CONFLICT DO NOTHING
+                            RETURNING name''', (migration,)).fetchone() is not None
+
+
+def _migrate_empty_persistence_data(con: psycopg.Connection) -> None:
+    # chat data used to be stored, and every user seen had a row even without data
+    if not _first_run(con, 'empty_persistence_data'):
+        return
+
+    _logger.info('Removing chat data and empty user data...')
+    con.execute('''DELETE FROM persistence_data
+                    WHERE kind = 'chat' OR data = ANY(%s)''',
+                ([pickle.dumps({}, protocol)
+                  for protocol in range(2, pickle.HIGHEST_PROTOCOL + 1)],))
+
+
+def _migrate_raffle_arrays(con: psycopg.Connection) -> None:
+    # raffles used to store their entries as parallel arrays in the raffle row
+    has_arrays = con.execute('''SELECT 1 FROM information_schema.columns
+                                WHERE table_schema = current_schema()
+                                    AND table_name = 'raffle'
+                                    AND column_name = 'dates' ''').fetchone()
+
+    if not has_arrays:
+        return
+
+    _logger.info('Migrating raffle entries to the raffle_entry table...')
+    con.execute('''INSERT INTO raffle_entry (chat_id, date, name, amount)
+                    SELECT r.chat_id, e.date, e.name, e.amount
+                    FROM raffle AS r,
+                        unnest(r.dates, r.entries, r.amounts)
+                            WITH ORDINALITY AS e(date, name, amount, n)
+                    ORDER BY r.chat_id, e.n''')
+    con.execute('''ALTER TABLE raffle
+                    DROP COLUMN dates,
+                    DROP COLUMN entries,
+                    DROP COLUMN amounts''')
+
+
+def _migrate_derived_series(con: psycopg.Connection) -> None:
+    # the series are made NOT NULL once every entry has them
+    nullable = con.execute('''SELECT is_nullable FROM information_schema.columns
+                                WHERE table_schema = current_schema()
+                                    AND table_name = 'raffle_entry'
+                                    AND column_name = 'pool' ''').fetchone()
+
+    if nullable == ('NO',):
+        return
+
+    chat_ids = con.execute('''SELECT DISTINCT e.chat_id, r.entry_fee
+                                FROM raffle_entry AS e, raffle AS r
+                                WHERE e.pool IS NULL AND r.chat_id = e.chat_id''').fetchall()
+
+    if chat_ids:
+        _logger.info('Deriving raffle series for %d raffles...', len(chat_ids))
+
+    for chat_id, entry_fee in chat_ids:
+        rows = con.execute('''SELECT entry_id, name, amount FROM raffle_entry
+                                WHERE chat_id = %s
+                                ORDER BY date, entry_id''', (chat_id,)).fetchall()
+        entry_ids, names, amounts = (list(col) for col in zip(*rows))
+        series = raffle.derive_series(pd.Series(names, dtype=object).values,
+                                      pd.Series(amounts, dtype='int64').values, entry_fee)
+        con.execute('''UPDATE raffle_entry AS e
+                        SET pool = d.pool, entrants = d.entrants,
+                            win_odds = d.win_odds, next_expected = d.next_expected
+                        FROM unnest(%s::bigint[], %s::bigint[], %s::integer[],
+                                    %s::double precision[], %s::bigint[])
+                            AS d(entry_id, pool, entrants, win_odds, next_expected)
+                        WHERE e.entry_id = d.entry_id''',
+                    (entry_ids, *(column.tolist() for column in series)))
+
+    # entries without a raffle have no entry fee to derive them with
+    con.execute('DELETE FROM raffle_entry WHERE pool IS NULL')
+    con.execute('''ALTER TABLE raffle_entry
+                    ALTER COLUMN pool SET NOT NULL,
+                    ALTER COLUMN entrants SET NOT NULL,
+                    ALTER COLUMN win_odds SET NOT NULL,
+                    ALTER COLUMN next_expected SET NOT NULL''')
+
+
+async def open_pool(url: str) -> None:
+    global _POOL  # pylint: disable=global-statement
+
+    if not _POOL:
+        _logger.info('Opening DB connection pool...')
+        _POOL = AsyncConnectionPool(url,
+                                    connection_class=(profiling.ProfilingConnection
+                                                      if profiling.DB_PROFILE
+                                                      else psycopg.AsyncConnection),
+                                    min_size=DB_POOL_MIN_SIZE,
+                                    max_size=DB_POOL_MAX_SIZE,
+                                    timeout=DB_TIMEOUT,
+                                    open=False)
+        await _POOL.open(wait=True, timeout=DB_TIMEOUT)
+        _logger.info('DB connection pool opened!')
+
+        # create the tables on startup rather than on import,
+        # in a thread as the initialization uses a blocking connection
+        await asyncio.get_running_loop().run_in_executor(None, _init_db, url)
+
+
+async def close_pool() -> None:
+    global _POOL  # pylint: disable=global-statement
+
+    if _POOL:
+        await registrations.drain()
+        await _POOL.close()
+        _POOL = None
+
+
+def _with_timeout(func: Callable[..., Awaitable[T]]) -> Callable[..., Awaitable[T]]:
+    # bound every DB call, so a stalled connection can't hang a handler forever
+    @wraps(func)
+    async def wrapper(*args: Any, **kwargs: Any) -> T:
+        if profiling.DB_PROFILE:
+            # the call runs in a task of its own, which copies the current context
+            token = profiling.current_function.set(func.__name__)
+            start = time.perf_counter()
+
+        try:
+            return await asyncio.wait_for(func(*args, **kwargs), timeout=DB_TIMEOUT)
+        except asyncio.TimeoutError as e:
+            raise PSErrors.OperationalError(
+                f'{func.__name__} timed out after {DB_TIMEOUT} s') from e
+        finally:
+            if profiling.DB_PROFILE:
+                profiling.record_call(func.__name__, time.perf_counter() - start)
+                profiling.current_function.reset(token)
+
+    return wrapper
+
+
+async def _fetchone(query: str, params: Any = None) -> Optional[Tuple[Any, ...]]:
+    async with _POOL.connection() as con:
+        cur = await con.execute(query, params)
+        return await cur.fetchone()
+
+
+async def _fetchall(query: str, params: Any = None) -> List[Tuple[Any, ...]]:
+    async with _POOL.connection() as con:
+        cur = await con.execute(query, params)
+        return await cur.fetchall()
+
+
+async def _execute(query: str, params: Any = None) -> None:
+    # the pooled connection commits on success and rolls back on error
+    async with _POOL.connection() as con:
+        await con.execute(query, params)
+
+
+@_with_timeout
+async def get_registered_member_ids(chat_id: int) -> List[int]:
+    return [row[0] for row in await _fetchall(
+        '''SELECT chat_user.user_id
+            FROM chat_user, in_chat
+            WHERE chat_id = %s AND chat_user.user_id = in_chat.user_id''', (chat_id,))]
 
 
-def get_registered_member_ids(chat_id: int) -> List[int]:
-    return [row[0] for row in _CON.execute(
+@_with_timeout
+async def get_registered_member_id(chat_id: int, username: str) -> Optional[int]:
+    row = await _fetchone(
         '''SELECT chat_user.user_id
             FROM chat_user, in_chat
-            WHERE chat_id = %s AND chat_user.user_id = in_chat.user_id''', (chat_id,)).fetchall()]
+            WHERE chat_id = %s
+                AND chat_user.user_id = in_chat.user_id
+                AND lower(username) = lower(%s)''', (chat_id, username))
+    return row[0] if row else None
+
 
+def _to_chat_state(row: Optional[Tuple[Any, ...]]) -> Optional[ChatState]:
+    if row is None:
+        return None
 
-def get_admin_ids(chat_id: int) -> List[int]:
-    return (_CON.execute(
-        'SELECT admins FROM chat WHERE chat_id = %s', (chat_id,))
-        .fetchone()[0])
+    admins, prev_winners, cur_winner = row
+    return ChatState(admins or [], prev_winners or [], cur_winner)
 
 
-def get_prev_winner_ids(chat_id: int) -> List[int]:
-    return (_CON.execute(
-        'SELECT prev_winners FROM chat WHERE chat_id = %s', (chat_id,))
-        .fetchone()[0])
+@_with_timeout
+async def get_chat_state(chat_id: int) -> Optional[ChatState]:
+    state = chat_state_cache.get(chat_id)
 
+    if state is MISSING:
+        state = _to_chat_state(await _fetchone(
+            f'SELECT {_CHAT_STATE_COLUMNS} FROM chat WHERE chat_id = %s', (chat_id,)))
+        if state is not None:
+            chat_state_cache.put(chat_id, state)
 
-def get_winner_id(chat_id: int) -> int:
-    return (_CON.execute(
-        'SELECT cur_winner FROM chat WHERE chat_id = %s', (chat_id,))
-        .fetchone()[0])
+    return state
 
 
-def get_chats_where_winner(user_id: int) -> List[Tuple[int, str]]:
-    return _CON.execute(
+@_with_timeout
+async def get_chats_where_winner(user_id: int) -> List[Tuple[int, str]]:
+    return await _fetchall(
         '''SELECT c.chat_id, c.title
             FROM chat AS c, in_chat as i
             WHERE i.user_id = %(id)s
                 AND c.chat_id = i.chat_id
                 AND (c.cur_winner = %(id)s)''',
-        {'id': user_id}).fetchall()
+        {'id': user_id})
+
+
+async def _fetch_raffle_entries(con: psycopg.AsyncConnection,
+                                chat_id: int,
+                                since: Optional['Timestamp'] = None,
+                                until: Optional['Timestamp'] = None) -> List[RaffleEntry]:
+    cur = await con.execute('''SELECT date, name, amount
+                                FROM raffle_entry
+                                WHERE chat_id = %(chat_id)s
+                                    AND (%(since)s::timestamp IS NULL OR date >= %(since)s)
+                                    AND (%(until)s::timestamp IS NULL OR date <= %(until)s)
+                                ORDER BY entry_id''',
+                            {'chat_id': chat_id, 'since': since, 'until': until})
+    return await cur.fetchall()
+
+
+async def _copy_raffle_entries(con: psycopg.AsyncConnection,
+                               chat_id: int,
+                               df: 'DataFrame',
+                               entry_fee: int,
+                               state: Optional['SeriesState'] = None) -> None:
+    # entries are stored in date order, with the series derived from them
+    df = df.sort_values('date', kind='stable')
+    amounts = df['amount'].round().astype('int64')
+    series = raffle.derive_series(df['name'].values, amounts.values, entry_fee,
+                                  state or raffle.SeriesState())
+    # formatted as CSV in one go rather than row by row, empty names are NULL
+    data = pd.DataFrame({
+        'chat_id': chat_id,
+        'date': raffle.format_dates(df['date'].values),
+        'name': df['name'].values,
+        'amount': amounts.values,
+        **series._asdict()
+    }).to_csv(header=False, index=False)
+
+    async with con.cursor() as cur:
+        async with cur.copy('''COPY raffle_entry (chat_id, date, name, amount,
+                                    pool, entrants, win_odds, next_expected)
+                                FROM STDIN (FORMAT CSV)''') as copy:
+            await copy.write(data)
+
+
+@_with_timeout
+async def get_raffle_data(chat_id: int) -> Optional[Tuple[
+        int, 'Timestamp', 'Timestamp', int, 'RaffleEntries']]:
+    async with _POOL.connection() as con:
+        cur = await con.execute('''SELECT chat_id, start_date, end_date, entry_fee
+                                    FROM raffle WHERE chat_id = %s''', (chat_id,))
+        row = await cur.fetchone()
+
+        if row is None:
+            return None
+
+        # the entries are packed into a single value of 64-bit integers, which
+        # is read straight into arrays rather than converted row by row
+        cur = con.cursor(binary=True)
+        await cur.execute('''SELECT string_agg(timestamp_send(date)
+                                                || int8send(amount::bigint)
+                                                || int8send(pool)
+                                                || int8send(entrants::bigint)
+                                                || int8send(next_expected),
+                                            '' ORDER BY date, entry_id)
+                                FROM raffle_entry
+                                WHERE chat_id = %s''', (chat_id,))
+        (data,) = await cur.fetchone()
+
+    return (*row, raffle.entries_from_bytes(data or b''))
+
+
+@_with_timeout
+async def get_raffle_entries(chat_id: int,
+                             since: Optional['Timestamp'] = None,
+                             until: Optional['Timestamp'] = None) -> List[RaffleEntry]:
+    async with _POOL.connection() as con:
+        return await _fetch_raffle_entries(con, chat_id, since, until)
+
+
+async def _archive_raffle(con: psycopg.AsyncConnection, chat_id: int) -> None:
+    # moves the entries of the chat's raffle to the archive, with a summary
+    # taken from the series of its last entry, raffles without entries are dropped
+    await con.execute('SELECT 1 FROM raffle WHERE chat_id = %s FOR UPDATE', (chat_id,))
+    cur = await con.execute('''INSERT INTO raffle_history (chat_id, start_date, end_date, entry_fee,
+                                                        entries, entrants, pool)
+                                SELECT r.chat_id, r.start_date, r.end_date, r.entry_fee,
+                                    count(*), max(e.entrants), max(e.pool)
+                                FROM raffle AS r, raffle_entry AS e
+                                WHERE r.chat_id = %s AND e.chat_id = r.chat_id
+                                GROUP BY r.chat_id
+                                RETURNING raffle_id''', (chat_id,))
+    row = await cur.fetchone()
+
+    if row is None:
+        return
+
+    (raffle_id,) = row
+    cur = await con.execute('''SELECT extract(year FROM min(date))::int,
+                                    extract(year FROM max(date))::int
+                                FROM raffle_entry WHERE chat_id = %s''', (chat_id,))
+    first_year, last_year = await cur.fetchone()
+
+    for year in range(first_year, last_year + 1):
+        await con.execute(sql.SQL('''CREATE TABLE IF NOT EXISTS {}
+                                    PARTITION OF raffle_entry_archive
+                                    FOR VALUES FROM ({}) TO ({})''').format(
+            sql.Identifier(f'raffle_entry_archive_{year}'),
+            sql.Literal(f'{year}-01-01'), sql.Literal(f'{year + 1}-01-01')))
+
+    await con.execute('''INSERT INTO raffle_entry_archive (raffle_id, date, name, amount)
+                        SELECT %s, date, name, amount
+                        FROM raffle_entry
+                        WHERE chat_id = %s
+                        ORDER BY date, entry_id''', (raffle_id, chat_id))
+    await con.execute('DELETE FROM raffle_entry WHERE chat_id = %s', (chat_id,))
+
+
+@_with_timeout
+async def save_raffle_data(chat_id: int,
+                           start_date: 'Timestamp',
+                           end_date: 'Timestamp',
+                           entry_fee: int,
+                           df: 'DataFrame') -> None:
+    async with _POOL.connection() as con:
+        await _archive_raffle(con, chat_id)
+        await con.execute('''INSERT INTO raffle (chat_id, start_date, end_date, entry_fee)
+                            VALUES (%s, %s, %s, %s)
+                            ON CONFLICT (chat_id)
+                            DO UPDATE SET
+                                start_date = EXCLUDED.start_date,
+                                end_date = EXCLUDED.end_date,
+                                entry_fee = EXCLUDED.entry_fee''',
+                          (chat_id, start_date, end_date, entry_fee))
+        await con.execute('DELETE FROM raffle_entry WHERE chat_id = %s', (chat_id,))
+        await _copy_raffle_entries(con, chat_id, df, entry_fee)
+
+    render_cache.invalidate(chat_id)
+
+
+def _hash_entries(df: 'DataFrame') -> List[int]:
+    return pd.util.hash_pandas_object(df[['date', 'name', 'amount']], index=False).tolist()
+
+
+@_with_timeout
+async def append_raffle_data(chat_id: int, df: 'DataFrame') -> int:
+    # uploads are cumulative exports, so entries before the latest stored one
+    # are already stored and only entries from that moment on are compared
+    df = df.assign(amount=df['amount'].round().astype(int))
+
+    async with _POOL.connection() as con:
+        # lock the raffle so concurrent uploads can't append the same entries
+        cur = await con.execute('SELECT entry_fee FROM raffle WHERE chat_id = %s FOR UPDATE',
+                                (chat_id,))
+        row = await cur.fetchone()
+
+        if row is None:
+            raise NoRaffleError(f'No raffle found for chat {chat_id}')
+
+        (entry_fee,) = row
+        cur = await con.execute('SELECT max(date) FROM raffle_entry WHERE chat_id = %s',
+                                (chat_id,))
+        (latest,) = await cur.fetchone()
+
+        if latest is not None:
+            df = df[df['date'] >= latest]
+            stored = pd.DataFrame(await _fetch_raffle_entries(con, chat_id, since=latest),
+                               columns=['date', 'name', 'amount'])
+            # an entry is new if it occurs more often than it's already stored
+            stored_counts = Counter(_hash_entries(stored))
+            is_new = []
+            for entry_hash in _hash_entries(df):
+                is_new.append(stored_counts[entry_hash] == 0)
+                if stored_counts[entry_hash] > 0:
+                    stored_counts[entry_hash] -= 1
+            df = df[is_new]
+
+        if len(df) > 0:
+            # new entries come after every stored one, so their series
+            # carry on from the last stored entry
+            cur = await con.execute('''SELECT pool, entrants FROM raffle_entry
+                                        WHERE chat_id = %s
+                                        ORDER BY date DESC, entry_id DESC
+                                        LIMIT 1''', (chat_id,))
+            pool, entrants = await cur.fetchone() or (0, 0)
+            cur = await con.execute('''SELECT DISTINCT name FROM raffle_entry
+                                        WHERE chat_id = %s AND name = ANY(%s)''',
+                                    (chat_id, df['name'].unique().tolist()))
+            seen_names = [name for (name,) in await cur.fetchall()]
+            await _copy_raffle_entries(con, chat_id, df, entry_fee,
+                                       raffle.SeriesState(pool, entrants, seen_names))
+
+    if len(df) > 0:
+        render_cache.invalidate(chat_id)
+
+    return len(df)
+
+
+@_with_timeout
+async def delete_raffle_data(chat_id: int) -> None:
+    # the raffle along with the chat's past raffles
+    async with _POOL.connection() as con:
+        await con.execute('''DELETE FROM raffle_entry_archive
+                            WHERE raffle_id IN (SELECT raffle_id FROM raffle_history
+                                                WHERE chat_id = %s)''', (chat_id,))
+        await con.execute('DELETE FROM raffle_history WHERE chat_id = %s', (chat_id,))
+        await con.execute('DELETE FROM raffle WHERE chat_id = %s', (chat_id,))
+    render_cache.invalidate(chat_id)
+
+
+@_with_timeout
+async def get_raffle_history(chat_id: int, limit: int = 10) -> List[Tuple[
+        'Timestamp', 'Timestamp', int, int, int, int]]:
+    # (start_date, end_date, entry_fee, entries, entrants, pool), newest first
+    return await _fetchall('''SELECT start_date, end_date, entry_fee, entries, entrants, pool
+                                FROM raffle_history
+                                WHERE chat_id = %s
+                                ORDER BY end_date DESC
+                                LIMIT %s''', (chat_id, limit))
+
+
+async def _save_username(con: psycopg.AsyncConnection,
+                         user_id: int,
+                         username: Optional[str]) -> None:
+    # usernames can change hands, so release it from whoever had it before
+    if username is not None:
+        await con.execute('''UPDATE chat_user SET username = NULL
+                            WHERE lower(username) = lower(%s) AND user_id <> %s''',
+                          (username, user_id))
+    await con.execute('''INSERT INTO chat_user (user_id, username)
+                        VALUES (%s, %s)
+                        ON CONFLICT (user_id)
+                        DO UPDATE SET username = EXCLUDED.username
+                        WHERE chat_user.username IS DISTINCT FROM EXCLUDED.username''',
+                      (user_id, username))
+
+
+@_with_timeout
+async def save_usernames(users: List[Tuple[int, Optional[str]]]) -> None:
+    async with _POOL.connection() as con:
+        for user_id, username in users:
+            await _save_username(con, user_id, username)
+
+
+@_with_timeout
+async def save_chat_or_ignore(chat_id: int, title: str, admin_ids: List[int]) -> None:
+    await _execute('''INSERT INTO chat (chat_id, title, admins)
+                            VALUES (%s, %s, %s)
+                            ON CONFLICT (chat_id)
+                            DO NOTHING''',
+                   (chat_id, title, admin_ids))
+    chat_state_cache.invalidate(chat_id)
+
+
+@_with_timeout
+async def delete_chat(chat_id: int) -> None:
+    async with _POOL.connection() as con:
+        await con.execute('''DELETE FROM in_chat where chat_id=%s''', (chat_id,))
+        await con.execute('''DELETE FROM chat where chat_id=%s''', (chat_id,))
+    chat_state_cache.invalidate(chat_id)
+
+
+class Registration(NamedTuple):
+    chat_id: int
+    user_id: int
+    username: Optional[str]
+
+
+def _claimed_usernames(batch: List[Registration]) -> Dict[int, Optional[str]]:
+    # the username each user ends up with, as if the registrations were written in order
+    usernames: Dict[int, Optional[str]] = {}
+    for reg in batch:
+        if reg.username is not None:
+            for user_id, username in usernames.items():
+                if username is not None and username.lower() == reg.username.lower():
+                    usernames[user_id] = None
+        usernames[reg.user_id] = reg.username
+    return usernames
+
+
+@_with_timeout
+async def _register_batch(batch: List[Registration]) -> List[bool]:
+    # whether each registration was new, in one transaction
+    usernames = _claimed_usernames(batch)
+    claims = [(user_id, username.lower()) for user_id, username in usernames.items()
+              if username is not None]
+
+    async with _POOL.connection() as con:
+        # usernames are released from whoever had them before, users of the batch
+        # included, as the unique index is checked row by row on the upsert
+        await con.execute('''UPDATE chat_user SET username = NULL
+                            WHERE lower(username) = ANY(%s)
+                            AND (user_id, lower(username)) NOT IN (
+                                SELECT * FROM unnest(%s::bigint[], %s::text[]))''',
+                          ([username for _, username in claims],
+                           [user_id for user_id, _ in claims],
+                           [username for _, username in claims]))
+        await con.execute('''INSERT INTO chat_user (user_id, username)
+                            SELECT * FROM unnest(%s::bigint[], %s::varchar[])
+                            ON CONFLICT (user_id)
+                            DO UPDATE SET username = EXCLUDED.username
+                            WHERE chat_user.username IS DISTINCT FROM EXCLUDED.username''',
+                          (list(usernames), list(usernames.values())))
+        cur = await con.execute('''INSERT INTO in_chat (user_id, chat_id)
+                                    SELECT * FROM unnest(%s::bigint[], %s::bigint[])
+                                    ON CONFLICT DO NOTHING
+                                    RETURNING user_id, chat_id''',
+                                ([reg.user_id for reg in batch], [reg.chat_id for reg in batch]))
+        new = set(await cur.fetchall())
+
+    # a registration repeated within the batch is already registered by the first one
+    results = []
+    for reg in batch:
+        results.append((reg.user_id, reg.chat_id) in new)
+        new.discard((reg.user_id, reg.chat_id))
+    return results
+
+
+class RegistrationBatcher:
+    """Writes registrations made close together in one transaction.
+
+    Each registration waits for the batch it's in, which is written when it
+    has max_size registrations or delay seconds after its first one.
+    """
+
+    def __init__(self, max_size: int, delay: float) -> None:
+        self.max_size = max(max_size, 1)
+        self.delay = delay
+        self._queue: List[Tuple[Registration, 'asyncio.Future[bool]']] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._writes: Set['asyncio.Task[None]'] = set()
+
+    async def register(self, chat_id: int, user_id: int, username: Optional[str]) -> bool:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queue.append((Registration(chat_id, user_id, username), future))
+
+        if len(self._queue) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.delay, self._flush)
+
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        batch, self._queue = self._queue, []
+        if batch:
+            task = asyncio.ensure_future(self._write(batch))
+            self._writes.add(task)
+            task.add_done_callback(self._writes.discard)
+
+    async def _write(self, batch: List[Tuple[Registration, 'asyncio.Future[bool]']]) -> None:
+        results: List[Any]
+        try:
+            results = await _register_batch([reg for reg, _ in batch])
+        except PSErrors.IntegrityError as e:
+            if len(batch) > 1:
+                # one bad registration, like one in an unknown chat, fails the whole
+                # batch, so they're retried one by one, in order, to fail only that one
+                for item in batch:
+                    await self._write([item])
+                return
+            results = [e]
+        except Exception as e:  # pylint: disable=broad-except
+            # everyone waiting for the batch gets its error
+            results = [e] * len(batch)
+
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def drain(self) -> None:
+        # write the queued registrations and wait for the batches being written
+        self._flush()
+        if self._writes:
+            await asyncio.wait(list(self._writes))
+
+
+registrations = RegistrationBatcher(REGISTER_BATCH_SIZE, REGISTER_BATCH_DELAY_MS / 1000)
+
+
+async def register_user(chat_id: int, user_id: int, username: Optional[str] = None) -> None:
+    if not await registrations.register(chat_id, user_id, username):
+        raise AlreadyRegisteredError
+
+
+async def register_user_or_ignore(chat_id: int,
+                                  user_id: int,
+                                  username: Optional[str] = None) -> None:
+    try:
+        await register_user(chat_id, user_id, username)
+    except AlreadyRegisteredError:
+        pass
 
 
-def get_raffle_data(chat_id: int) -> Tuple[
-        int, Timestamp, Timestamp, int,
-        List[Timestamp], List[str], List[int]]:
-    return _CON.execute(
-        'SELECT * FROM raffle WHERE chat_id = %s', [chat_id]).fetchone()
+async def _update_chat_state(query: str, params: Dict[str, Any]) -> Optional[ChatState]:
+    # one statement updates the winners and returns the state it left behind,
+    # which is written through to the cache
+    chat_id = params['chat_id']
+    state = _to_chat_state(await _fetchone(
+        f'{query} RETURNING {_CHAT_STATE_COLUMNS}', params))
 
+    if state is None:
+        chat_state_cache.invalidate(chat_id)
+    else:
+        chat_state_cache.put(chat_id, state)
 
-def save_raffle_data(chat_id: int,
-                     start_date: Timestamp,
-                     end_date: Timestamp,
-                     entry_fee: int,
-                     df: DataFrame) -> None:
+    return state
 
-    dates = df['date'].tolist()
-    entries = df['name'].tolist()
-    amounts = df['amount'].tolist()
 
-    _CON.execute('''INSERT INTO raffle
-                    VALUES (%s, %s, %s, %s, %s, %s, %s)
-                    ON CONFLICT (chat_id)
-                    DO UPDATE SET 
-                        start_date = EXCLUDED.start_date,
-                        end_date = EXCLUDED.end_date,
-                        entry_fee = EXCLUDED.entry_fee,
-                        dates = EXCLUDED.dates,
-                        entries = EXCLUDED.entries,
-                        amounts = EXCLUDED.amounts''',
-                 (chat_id, start_date, end_date, entry_fee, dates, entries, amounts))
+@_with_timeout
+async def admin_cycle_winners(winner_id: int, chat_id: int) -> Optional[ChatState]:
+    return await _update_chat_state('''UPDATE chat
+                            SET prev_winners = array_append(prev_winners, cur_winner),
+                                cur_winner=%(winner_id)s
+                            WHERE chat_id=%(chat_id)s''',
+                                    {'winner_id': winner_id, 'chat_id': chat_id})
 
-    _CON.commit()
 
+@_with_timeout
+async def replace_cur_winner(winner_id: int, chat_id: int) -> Optional[ChatState]:
+    return await _update_chat_state('''UPDATE chat
+                            SET cur_winner=%(winner_id)s
+                            WHERE chat_id=%(chat_id)s''',
+                                    {'winner_id': winner_id, 'chat_id': chat_id})
 
-def delete_raffle_data(chat_id: int):
-    _CON.execute('''DELETE FROM raffle where chat_id=%s''', (chat_id,))
-    _CON.commit()
 
+@_with_timeout
+async def cycle_winners(user_id: int, winner_id: int, chat_id: int) -> Optional[ChatState]:
+    return await _update_chat_state('''UPDATE chat
+                            SET prev_winners=array_append(prev_winners, %(user_id)s),
+                                cur_winner=%(winner_id)s
+                            WHERE chat_id=%(chat_id)s''',
+                                    {'user_id': user_id, 'winner_id': winner_id,
+                                     'chat_id': chat_id})
 
-def save_user_or_ignore(user_id: int) -> None:
-    _CON.execute('''INSERT INTO chat_user
-                VALUES (%s)
-                ON CONFLICT (user_id)
-                DO NOTHING''',
-                 (user_id,))
 
-    _CON.commit()
+@_with_timeout
+async def get_persistence_data(kind: str, data_id: int) -> Optional[bytes]:
+    row = await _fetchone('SELECT data FROM persistence_data WHERE kind = %s AND id = %s',
+                          (kind, data_id))
+    return row[0] if row else None
 
 
-def save_chat_or_ignore(chat_id: int, title: str, admin_ids: List[int]) -> None:
-    _CON.execute('''INSERT INTO chat (chat_id, title, admins)
-                            VALUES (%s, %s, %s)
-                            ON CONFLICT (chat_id)
-                            DO NOTHING''',
-                 (chat_id, title, admin_ids))
-    _CON.commit()
-
+@_with_timeout
+async def save_persistence_data(kind: str, data_id: int, data: bytes) -> None:
+    await _execute('''INSERT INTO persistence_data (kind, id, data)
+                        VALUES (%s, %s, %s)
+                        ON CONFLICT (kind, id)
+                        DO UPDATE SET data = EXCLUDED.data''',
+                   (kind, data_id, data))
 
-def delete_chat(chat_id: int):
-    _CON.execute('''DELETE FROM chat where chat_id=%s''', (chat_id,))
-    _CON.commit()
 
+@_with_timeout
+async def delete_persistence_data(kind: str, data_id: int) -> None:
+    await _execute('DELETE FROM persistence_data WHERE kind = %s AND id = %s',
+                   (kind, data_id))
 
 
-def register_user(chat_id: int, user_id: int) -> None:
+@_with_timeout
+async def get_conversation_states(name: str) -> List[Tuple[str, bytes]]:
+    return await _fetchall('SELECT key, state FROM conversation_state WHERE name = %s',
+                           (name,))
 
-    save_user_or_ignore(user_id)
 
-    try:
-        _CON.execute('''INSERT INTO in_chat(user_id, chat_id)
-                            VALUES (%s, %s)''',
-                     (user_id, chat_id))
-    except PSErrors.UniqueViolation as e:
-        _CON.rollback()
-        raise AlreadyRegisteredError from e
+@_with_timeout
+async def save_conversation_state(name: str, key: str, state: Optional[bytes]) -> None:
+    # ended conversations are deleted, so only ongoing ones are ever loaded
+    if state is None:
+        await _execute('DELETE FROM conversation_state WHERE name = %s AND key = %s',
+                       (name, key))
     else:
-        _CON.commit()
-
-
-def register_user_or_ignore(chat_id: int, user_id: int) -> None:
-    try:
-        register_user(chat_id, user_id)
-    except AlreadyRegisteredError:
-        pass
-
-
-def admin_cycle_winners(winner_id: int, chat_id: int) -> None:
-    _CON.execute('''UPDATE chat
-                            SET prev_winners = array_append(prev_winners, cur_winner),
-                                cur_winner=%s
-                            WHERE chat_id=%s''',
-                 (winner_id, chat_id))
-    _CON.commit()
-
-
-def replace_cur_winner(winner_id: int, chat_id: int) -> None:
-    _CON.execute('''UPDATE chat
-                            SET cur_winner=%s
-                            WHERE chat_id=%s''',
-                 (winner_id, chat_id))
-    _CON.commit()
-
-
-def cycle_winners(user_id: int, winner_id: int, chat_id: int) -> None:
-    _CON.execute('''UPDATE chat
-                            SET prev_winners=array_append(prev_winners, %s),
-                                cur_winner=%s'
-                            WHERE chat_id=%s''',
-                 (user_id, winner_id, chat_id))
-    _CON.commit()
+        await _execute('''INSERT INTO conversation_state (name, key, state)
+                            VALUES (%s, %s, %s)
+                            ON CONFLICT (name, key)
+                            DO UPDATE SET state = EXCLUDED.state''',
+                       (name, key, state))
@@ -0,0 +1,64 @@
+import os
+from io import BytesIO
+from typing import NamedTuple, Tuple
+import numpy as np
+from PIL import Image
+from matplotlib.figure import Figure
+
+IMAGE_FORMATS = ('png', 'jpeg', 'webp')
+
+
+class ImageFormat(NamedTuple):
+    # png, jpeg or webp
+    format: str = 'png'
+    dpi: float = 100
+    # width and height in inches
+    size: Tuple[float, float] = (6.4, 4.8)
+    # zlib level of png, 0-9
+    png_compression: int = 6
+    # palette size of png, 0 keeps full color
+    colors: int = 0
+    # quality of jpeg and webp, 1-100
+    quality: int = 85
+
+
+def _setting(name: str, graph_type: str, default: str) -> str:
+    # GRAPH_<NAME>_<GRAPH TYPE> overrides GRAPH_<NAME> for one graph type
+    return os.getenv(f'GRAPH_{name}_{graph_type.upper()}',
+                     default=os.getenv(f'GRAPH_{name}', default=default))
+
+
+def image_format(graph_type: str) -> ImageFormat:
+    default = ImageFormat()
+
+    fmt = _setting('FORMAT', graph_type, default.format).lower().replace('jpg', 'jpeg')
+    if fmt not in IMAGE_FORMATS:
+        raise ValueError(f'Unsupported graph image format: {fmt}')
+
+    width, height = (float(x) for x in
+                     _setting('SIZE', graph_type, 'x'.join(map(str, default.size))).split('x'))
+
+    return ImageFormat(
+        format=fmt,
+        dpi=float(_setting('DPI', graph_type, str(default.dpi))),
+        size=(width, height),
+        png_compression=int(_setting('PNG_COMPRESSION', graph_type, str(default.png_compression))),
+        colors=int(_setting('COLORS', graph_type, str(default.colors))),
+        quality=int(_setting('QUALITY', graph_type, str(default.quality))))
+
+
+def encode(fig: Figure, fmt: ImageFormat) -> bytes:
+    # the figure is drawn at its own size and dpi, which the template sets
+    fig.canvas.draw()
+    img = Image.fromarray(np.asarray(fig.canvas.buffer_rgba())).convert('RGB')
+
+    out = BytesIO()
+    if fmt.format == 'png':
+        if fmt.colors > 0:
+            # graphs have few colors apart from antialiasing, so a small palette is enough
+            img = img.quantize(fmt.colors, method=Image.Quantize.FASTOCTREE)
+        img.save(out, format='png', compress_level=fmt.png_compression)
+    else:
+        img.save(out, format=fmt.format, quality=fmt.quality)
+
+    return out.getvalue()
@@ -8,3 +8,7 @@ class NoRaffleError(Exception):
 
 class AlreadyRegisteredError(Exception):
     pass
+
+
+class InvalidExcelError(Exception):
+    pass
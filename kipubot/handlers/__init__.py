@@ -6,8 +6,11 @@ __all__ = (
     "winner_handler",
     "graph_handler",
     "expected_value_handler",
+    "history_handler",
     "raffle_setup_handler",
     "no_dm_handler",
+    "username_handler",
+    "member_update_handler",
     "error_handler"
 )
 
@@ -18,5 +21,8 @@ from ._excel_file_handler import excel_file_handler
 from ._bot_added_handler import bot_added_handler
 from ._winner_handler import winner_handler
 from ._graph_handlers import graph_handler, expected_value_handler
+from ._history_handler import history_handler
 from ._no_dm_handler import no_dm_handler
+from ._username_handler import username_handler
+from ._member_update_handler import member_update_handler
 from ._error_handler import error_handler
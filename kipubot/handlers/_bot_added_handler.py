@@ -4,7 +4,8 @@ from telegram.constants import ChatMemberStatus
 import psycopg.errors as PSErrors
 from kipubot.constants import STRINGS
 from kipubot.db import (save_chat_or_ignore,
-                        save_user_or_ignore, register_user_or_ignore)
+                        save_usernames, register_user_or_ignore)
+from kipubot.members import get_chat_administrators
 
 
 async def bot_added(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -16,14 +17,15 @@ async def bot_added(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.my_chat_member.new_chat_member.status != ChatMemberStatus.LEFT:
         chat_id = update.effective_chat.id
         title = update.effective_chat.title
-        user_id = update.effective_user.id
-        admins = await update.effective_chat.get_administrators()
-        admin_ids = list(set([admin.user.id for admin in admins] + [user_id]))
+        user = update.effective_user
+        admins = await get_chat_administrators(update.effective_chat)
+        admin_ids = list(set([admin.user.id for admin in admins] + [user.id]))
 
         try:
-            save_chat_or_ignore(chat_id, title, admin_ids)
-            save_user_or_ignore(user_id)
-            register_user_or_ignore(chat_id, user_id)
+            await save_chat_or_ignore(chat_id, title, admin_ids)
+            await save_usernames([(admin.user.id, admin.user.username) for admin in admins
+                                  if not admin.user.is_bot])
+            await register_user_or_ignore(chat_id, user.id, user.username)
 
         except PSErrors.IntegrityError as e:
             print('SQLite Error: ' + str(e))
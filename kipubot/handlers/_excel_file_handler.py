@@ -1,18 +1,30 @@
-import os
+import asyncio
+from io import BytesIO
 from typing import Optional
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes, ConversationHandler, MessageHandler
 import telegram.ext.filters as Filters
 from kipubot.constants import EXCEL_MIME, STRINGS
-from kipubot.utils import validate_excel
 from kipubot.db import get_chats_where_winner
+from kipubot.lazy import lazy_import
+
+# openpyxl and pandas are loaded on the first upload
+utils = lazy_import('kipubot.utils')
+
+# seconds the parsed entries are kept if no chat is chosen for them,
+# the raffle setup clears them itself once a chat is chosen
+ENTRIES_TIMEOUT = 120
+
+
+async def forget_raffle_entries(context: ContextTypes.DEFAULT_TYPE) -> None:
+    if 'raffle_chat_id' not in context.user_data:
+        context.user_data.pop('raffle_entries', None)
 
 
 async def excel_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Optional[str]:
     user_id = update.effective_user.id
-    dm_id = update.effective_chat.id
 
-    chats = get_chats_where_winner(user_id)
+    chats = await get_chats_where_winner(user_id)
 
     if len(chats) == 0:
         await update.message.reply_text(STRINGS['not_winner'])
@@ -20,20 +32,26 @@ async def excel_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Opti
 
     doc = update.message.document
     file = await context.bot.get_file(doc)
-    base_path = f'data/{dm_id}'
-    excel_path = base_path + '/data.xlsx'
+    excel_upload = BytesIO()
+    await file.download(out=excel_upload)
+    excel_upload.seek(0)
 
-    if not os.path.exists(base_path):
-        os.mkdir(base_path)
+    # parsing a large export takes seconds, so it is kept off the event loop
+    df = await asyncio.get_running_loop().run_in_executor(None, utils.parse_excel, excel_upload)
 
-    with open(excel_path, 'wb') as f:
-        await file.download(out=f)
-
-    if not validate_excel(excel_path):
+    if df is None:
         await update.message.reply_text(STRINGS['invalid_file'])
-        os.remove(excel_path)
         return
 
+    # keep the parsed entries until the raffle setup is finished
+    context.user_data['raffle_entries'] = df
+
+    job_name = f'forget_raffle_entries:{user_id}'
+    for job in context.job_queue.get_jobs_by_name(job_name):
+        job.schedule_removal()
+    context.job_queue.run_once(forget_raffle_entries, ENTRIES_TIMEOUT,
+                               name=job_name, user_id=user_id)
+
     chat_buttons = []
 
     for chat_id, chat_title in chats:
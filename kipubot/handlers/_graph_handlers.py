@@ -1,39 +1,66 @@
+import time
+import asyncio
 from enum import Enum
+from concurrent.futures.process import BrokenProcessPool
 from telegram import Update
 from telegram.ext import ContextTypes, CommandHandler
+from telegram.error import BadRequest
 import telegram.ext.filters as Filters
 import psycopg.errors as PSErrors
 from kipubot.errors import NoEntriesError, NoRaffleError
-from kipubot.utils import generate_graph, generate_expected
+from kipubot.lazy import lazy_import
+from kipubot.cache import render_cache
+from kipubot.render import render
+from kipubot.metrics import observe_render
 from kipubot.constants import STRINGS
 
+# pandas and matplotlib are loaded on the first graph request
+utils = lazy_import('kipubot.utils')
+
 
 class GraphType(Enum):
     EXPECTED = 'expected'
     GRAPH = 'graph'
 
 
-def get_graph_img(graph_type: GraphType) -> str:
-    if graph_type == GraphType.EXPECTED:
-        return 'expected.png'
-
-    return 'graph.png'
-
-
 async def graph(update: Update, _context: ContextTypes.DEFAULT_TYPE,
                 graph_type: GraphType = GraphType.GRAPH) -> None:
     chat_id = update.effective_chat.id
     chat_title = update.effective_chat.title
-    graph_path = f'data/{chat_id}/{get_graph_img(graph_type)}'
+    # take the key before rendering, so data changing mid-render
+    # can't get cached under the new data version
+    cache_key = render_cache.key(chat_id, graph_type.value)
 
     try:
-        if graph_type == GraphType.EXPECTED:
-            generate_expected(graph_path, chat_id, chat_title)
-        else:
-            generate_graph(graph_path, chat_id, chat_title)
+        # the same image was sent to the chat already, send it again by its file_id
+        file_id = render_cache.get_file_id(cache_key)
+        if file_id is not None:
+            try:
+                await update.message.reply_photo(photo=file_id)
+                return
+            except BadRequest:
+                # Telegram no longer knows the file, upload it again
+                render_cache.forget_file_id(cache_key)
+
+        async def render_graph() -> bytes:
+            start = time.perf_counter()
+            raffle_data = await utils.get_raffle(chat_id, include_entries=True)
+            fetch_seconds = time.perf_counter() - start
+
+            if graph_type == GraphType.EXPECTED:
+                img, stages = await render(utils.generate_expected, raffle_data, chat_title)
+            else:
+                img, stages = await render(utils.generate_graph, raffle_data, chat_title)
+
+            observe_render(graph_type.value, {'fetch': fetch_seconds, **stages})
+            return img
+
+        # requests arriving while the graph renders wait for the same render
+        img = await render_cache.get_or_render(cache_key, render_graph)
 
-        with open(graph_path, 'rb') as f:
-            await update.message.reply_photo(photo=f)
+        message = await update.message.reply_photo(photo=img)
+        if message.photo:
+            render_cache.put_file_id(cache_key, message.photo[-1].file_id)
 
     except NoRaffleError:
         await update.message.reply_text(STRINGS['no_raffle'] % {'chat_title': chat_title})
@@ -42,13 +69,16 @@ async def graph(update: Update, _context: ContextTypes.DEFAULT_TYPE,
     except PSErrors.Error as e:
         print(e)
         await update.message.reply_text(STRINGS['raffle_db_error'])
-    except FileNotFoundError:
-        await update.message.reply_text(STRINGS['no_data'] % {'chat_title': chat_title})
+    # renders in a pool stopped for another render's timeout fail with it
+    except (asyncio.TimeoutError, BrokenProcessPool):
+        await update.message.reply_text(STRINGS['render_timeout'])
 
+# not blocking, so a render doesn't hold up other updates
+# and renders of different chats run on the workers in parallel
 graph_handler = CommandHandler(
-    ['kuvaaja', 'graph'], graph, ~Filters.ChatType.PRIVATE)
+    ['kuvaaja', 'graph'], graph, ~Filters.ChatType.PRIVATE, block=False)
 
 expected_value_handler = CommandHandler(
     ['odotusarvo', 'expected'],
     lambda u, c: graph(u, c, graph_type=GraphType.EXPECTED),
-    ~Filters.ChatType.PRIVATE)
+    ~Filters.ChatType.PRIVATE, block=False)
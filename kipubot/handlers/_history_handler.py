@@ -0,0 +1,44 @@
+from datetime import timedelta
+from telegram import Update
+from telegram.ext import ContextTypes, CommandHandler
+import telegram.ext.filters as Filters
+from kipubot.constants import STRINGS
+from kipubot.db import get_raffle_history
+from kipubot.lazy import lazy_import
+
+utils = lazy_import('kipubot.utils')
+
+# number of past raffles listed
+HISTORY_LENGTH = 10
+
+
+def duration_to_str(duration: timedelta) -> str:
+    hours = round(duration.total_seconds() / 3600)
+    days, hours = divmod(hours, 24)
+
+    return f'{days} d {hours} h' if days else f'{hours} h'
+
+
+async def history(update: Update, _context: ContextTypes.DEFAULT_TYPE) -> None:
+    chat_id = update.effective_chat.id
+    chat_title = update.effective_chat.title
+
+    raffles = await get_raffle_history(chat_id, HISTORY_LENGTH)
+
+    if not raffles:
+        await update.message.reply_text(STRINGS['no_history'] % {'chat_title': chat_title})
+        return
+
+    msg = STRINGS['history'] % {'chat_title': chat_title}
+    for start_date, end_date, _, _, entrants, pool in raffles:
+        msg += STRINGS['history_raffle'] % {
+            'start_date': start_date.strftime('%d.%m.%Y'),
+            'end_date': end_date.strftime('%d.%m.%Y'),
+            'duration': duration_to_str(end_date - start_date),
+            'pool': utils.int_price_to_str(pool),
+            'entrants': entrants}
+
+    await update.message.reply_text(msg)
+
+history_handler = CommandHandler(
+    ['historia', 'history'], history, ~Filters.ChatType.PRIVATE)
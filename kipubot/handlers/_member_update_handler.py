@@ -0,0 +1,19 @@
+from telegram import Update
+from telegram.ext import ContextTypes, ChatMemberHandler
+from telegram.constants import ChatMemberStatus
+from kipubot.cache import admin_cache, member_cache
+
+
+async def member_updated(update: Update, _context: ContextTypes.DEFAULT_TYPE) -> None:
+    # keep cached member and administrator lookups in line with member status changes
+    chat_member = update.chat_member or update.my_chat_member
+    chat_id = update.effective_chat.id
+    old, new = chat_member.old_chat_member, chat_member.new_chat_member
+
+    member_cache.put((chat_id, new.user.id), new)
+
+    admin_statuses = (ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER)
+    if old.status in admin_statuses or new.status in admin_statuses:
+        admin_cache.invalidate(chat_id)
+
+member_update_handler = ChatMemberHandler(member_updated, ChatMemberHandler.ANY_CHAT_MEMBER)
@@ -13,7 +13,7 @@ async def hello(update: Update, _context: ContextTypes.DEFAULT_TYPE) -> None:
     chat = update.effective_chat.title
 
     try:
-        register_user(chat_id, user_id)
+        await register_user(chat_id, user_id, username)
 
     except AlreadyRegisteredError:
         await update.message.reply_text(STRINGS['double_moro'] %
@@ -22,5 +22,6 @@ async def hello(update: Update, _context: ContextTypes.DEFAULT_TYPE) -> None:
         await update.message.reply_text(STRINGS['moro'] %
                                         {'username': username, 'chat_title': chat})
 
+# not blocking, so /moros sent close together are handled at once and registered in one batch
 moro_handler = CommandHandler(
-    ['moro', 'hello'], hello, ~Filters.ChatType.PRIVATE)
+    ['moro', 'hello'], hello, ~Filters.ChatType.PRIVATE, block=False)
@@ -1,12 +1,13 @@
-import os
 from typing import Optional, Union
-import pandas as pd
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ConversationHandler, CallbackQueryHandler, CallbackContext
 from kipubot.constants import STRINGS
-from kipubot.utils import (get_raffle, save_raffle, read_excel_to_df, is_int,
-                           is_float, get_cur_time_hel, int_price_to_str)
 from kipubot.errors import NoRaffleError
+from kipubot.lazy import lazy_import
+
+# pandas is loaded when the first raffle is set up
+pd = lazy_import('pandas')
+utils = lazy_import('kipubot.utils')
 
 # ==================
 # = UTIL FUNCTIONS =
@@ -142,7 +143,7 @@ async def setup_raffle(update: Update, context: CallbackContext) -> Union[str, i
 
     if (query.data.startswith('raffle:chat_selected') and
             len(query.data.split(':')) == 4 and
-            is_int(query.data.split(':')[2])):
+            utils.is_int(query.data.split(':')[2])):
         args = query.data.split(':')
 
         chat_id = int(args[2])
@@ -153,7 +154,7 @@ async def setup_raffle(update: Update, context: CallbackContext) -> Union[str, i
         context.user_data['raffle_chat_title'] = chat_title
 
         try:
-            get_raffle(chat_id)
+            await utils.get_raffle(chat_id)
 
             msg = (STRINGS['raffle_setup_base'] + STRINGS['raffle_setup_update_or_new']) % {
                 'chat_title': chat_title}
@@ -176,12 +177,12 @@ async def setup_start_date(update: Update, context: CallbackContext) -> Optional
     query = update.callback_query
 
     if query.data == 'raffle:setup:new':
-        context.user_data['raffle_start_date'] = get_cur_time_hel().floor(
+        context.user_data['raffle_start_date'] = utils.get_cur_time_hel().floor(
             freq="15T")
 
     if (query.data.startswith('raffle:date:start:update') and
             len(query.data.split(':')) == 5 and
-            is_float(query.data.split(':')[4])):
+            utils.is_float(query.data.split(':')[4])):
 
         diff = float(query.data.split(':')[4])
         old_date = context.user_data['raffle_start_date']
@@ -212,7 +213,7 @@ async def setup_end_date(update: Update, context: CallbackContext) -> Optional[s
 
     if (query.data.startswith('raffle:date:end:update') and
             len(query.data.split(':')) == 5 and
-            is_float(query.data.split(':')[4])):
+            utils.is_float(query.data.split(':')[4])):
 
         diff = float(query.data.split(':')[4])
         old_date = context.user_data['raffle_end_date']
@@ -253,7 +254,7 @@ async def setup_fee(update: Update, context: CallbackContext) -> Optional[str]:
 
     if (query.data.startswith('raffle:fee:update') and
             len(query.data.split(':')) == 4 and
-            is_int(query.data.split(':')[3])):
+            utils.is_int(query.data.split(':')[3])):
 
         diff = int(query.data.split(':')[3])
         old_fee = context.user_data['raffle_fee']
@@ -275,7 +276,7 @@ async def setup_fee(update: Update, context: CallbackContext) -> Optional[str]:
             msg += STRINGS['negative_fee']
 
         msg = msg % {'chat_title': chat_title, 'start_date': start_date,
-                     'end_date': end_date, 'fee': int_price_to_str(fee)}
+                     'end_date': end_date, 'fee': utils.int_price_to_str(fee)}
 
         if query.message.text != msg:
             await query.message.edit_text(msg, reply_markup=fee_keyboard())
@@ -287,25 +288,22 @@ async def setup_fee(update: Update, context: CallbackContext) -> Optional[str]:
 
 async def finish_setup(update: Update, context: CallbackContext) -> Optional[int]:
     query = update.callback_query
-    dm_id = update.effective_chat.id
 
     if query.data == 'raffle:setup:old':
         chat_title = context.user_data['raffle_chat_title']
         chat_id = context.user_data['raffle_chat_id']
-        dm_id = update.effective_chat.id
 
-        start_date, end_date, entry_fee, _ = get_raffle(chat_id)
-        excel_path = f'data/{dm_id}/data.xlsx'
-        df = read_excel_to_df(excel_path, start_date, end_date)
-        save_raffle(chat_id, start_date, end_date, entry_fee, df)
+        start_date, end_date, _, _ = await utils.get_raffle(chat_id)
+        df = utils.filter_by_date(context.user_data['raffle_entries'], start_date, end_date)
+        new_entries = await utils.append_raffle(chat_id, df)
 
-        await query.message.edit_text(STRINGS['updated_raffle'] % {'chat_title': chat_title})
+        await query.message.edit_text(STRINGS['updated_raffle'] % {
+            'chat_title': chat_title, 'new_entries': new_entries})
         await context.bot.send_message(chat_id,
                                        STRINGS['raffle_updated_chat']
                                        % {'username': update.effective_user.username})
         # perform cleanup
         context.user_data.clear()
-        os.remove(excel_path)
 
         return ConversationHandler.END
 
@@ -316,9 +314,8 @@ async def finish_setup(update: Update, context: CallbackContext) -> Optional[int
         end_date = context.user_data['raffle_end_date']
         fee = context.user_data['raffle_fee']
 
-        excel_path = f'data/{dm_id}/data.xlsx'
-        df = read_excel_to_df(excel_path, start_date, end_date)
-        save_raffle(chat_id, start_date, end_date, fee, df)
+        df = utils.filter_by_date(context.user_data['raffle_entries'], start_date, end_date)
+        await utils.save_raffle(chat_id, start_date, end_date, fee, df)
 
         msg = (STRINGS['raffle_setup_base'] + STRINGS['raffle_setup_start_date'] +
                STRINGS['raffle_setup_end_date'] + STRINGS['raffle_setup_fee'] +
@@ -326,7 +323,7 @@ async def finish_setup(update: Update, context: CallbackContext) -> Optional[int
             'chat_title': chat_title,
             'start_date': start_date,
             'end_date': end_date,
-            'fee': int_price_to_str(fee)}
+            'fee': utils.int_price_to_str(fee)}
 
         await query.message.edit_text(msg, reply_markup=None)
         await context.bot.send_message(chat_id, STRINGS['raffle_created_chat']
@@ -334,7 +331,6 @@ async def finish_setup(update: Update, context: CallbackContext) -> Optional[int
 
         # perform cleanup
         context.user_data.clear()
-        os.remove(excel_path)
 
         return ConversationHandler.END
 
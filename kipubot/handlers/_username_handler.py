@@ -0,0 +1,36 @@
+import logging
+from telegram import Update
+from telegram.ext import ContextTypes, MessageHandler
+import telegram.ext.filters as Filters
+import psycopg.errors as PSErrors
+from kipubot.db import save_usernames
+from kipubot.cache import TTLCache
+
+# user_id -> most recently saved username of the recently active users,
+# so unchanged ones aren't written again
+_saved_usernames = TTLCache(10000, float('inf'))
+
+# LOGGER
+_logger = logging.getLogger(__name__)
+
+
+async def track_username(update: Update, _context: ContextTypes.DEFAULT_TYPE) -> None:
+    # keeps the username index up to date from ordinary group messages
+    user = update.effective_user
+
+    if user is None or user.is_bot:
+        return
+
+    if _saved_usernames.get(user.id) == user.username:
+        return
+
+    try:
+        await save_usernames([(user.id, user.username)])
+    except PSErrors.Error as e:
+        _logger.warning('Failed to save username of user %d: %s', user.id, e)
+        return
+
+    _saved_usernames.put(user.id, user.username)
+
+# a side write that doesn't need to hold up the updates after it
+username_handler = MessageHandler(Filters.ChatType.GROUPS, track_username, block=False)
@@ -1,14 +1,31 @@
-from telegram import Update
+from typing import Optional
+from telegram import Chat, Update
 from telegram.ext import ContextTypes, CommandHandler
 from telegram.constants import MessageEntityType
 import telegram.ext.filters as Filters
 import psycopg.errors as PSErrors
 from kipubot.constants import STRINGS
-from kipubot.db import (admin_cycle_winners, cycle_winners,
-                        get_registered_member_ids,
-                        get_admin_ids, get_prev_winner_ids,
-                        get_winner_id, replace_cur_winner)
-from kipubot.utils import get_chat_member_opt
+from kipubot.db import (admin_cycle_winners, cycle_winners, get_chat_state,
+                        get_registered_member_id, get_registered_member_ids,
+                        replace_cur_winner, save_usernames)
+from kipubot.members import get_chat_member_opt
+
+
+async def find_member_id(chat: Chat, username: str) -> Optional[int]:
+    member_id = await get_registered_member_id(chat.id, username)
+
+    if member_id is not None:
+        return member_id
+
+    # not in the username index, look through the registered members
+    for registered_id in await get_registered_member_ids(chat.id):
+        member = await get_chat_member_opt(chat, registered_id)
+
+        if member and member.user.username and member.user.username.lower() == username.lower():
+            await save_usernames([(member.user.id, member.user.username)])
+            return member.user.id
+
+    return None
 
 
 async def winner(update: Update, _context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -27,43 +44,41 @@ async def winner(update: Update, _context: ContextTypes.DEFAULT_TYPE) -> None:
     username = update.message.text.split(" ")[1][1:]
 
     try:
-        is_admin = user_id in get_admin_ids(chat_id)
-        is_cur_winner = user_id == get_winner_id(chat_id)
+        # admins and winners in one query, or none if cached
+        chat_state = await get_chat_state(chat_id)
 
-        prev_winner_ids = get_prev_winner_ids(chat_id)
-        is_prev_winner = prev_winner_ids and user_id == prev_winner_ids[-1]
+        if chat_state is None:
+            await update.message.reply_text(STRINGS['forbidden_command'])
+            return
+
+        is_admin = user_id in chat_state.admins
+        is_cur_winner = user_id == chat_state.cur_winner
+        is_prev_winner = (chat_state.prev_winners and
+                          user_id == chat_state.prev_winners[-1])
 
         if not is_admin and not is_cur_winner and not is_prev_winner:
             await update.message.reply_text(STRINGS['forbidden_command'])
             return
 
-        registered_member_ids = get_registered_member_ids(chat_id)
-        registered_members = [await get_chat_member_opt(update.effective_chat, id)
-                              for id in registered_member_ids]
-        # drop None values
-        registered_members = [m for m in registered_members if m]
-        supposed_winner = [
-            member for member in registered_members if member.user.username == username]
+        winner_id = await find_member_id(update.effective_chat, username)
 
-        if not supposed_winner:
+        if winner_id is None:
             await update.message.reply_text(STRINGS['user_not_found'])
             return
 
-        winner_id = supposed_winner[0].user.id
-
         if winner_id == user_id and not is_admin:
             await update.message.reply_text(STRINGS['already_winner'])
             return
 
         # admin: moves current to prev and makes new current
         if is_admin:
-            admin_cycle_winners(winner_id, chat_id)
+            await admin_cycle_winners(winner_id, chat_id)
         # prev_winner: replaces current winner directly (assumed typo)
         elif is_prev_winner:
-            replace_cur_winner(winner_id, chat_id)
+            await replace_cur_winner(winner_id, chat_id)
         # winner: moves themselves to prev and makes new current
         else:
-            cycle_winners(user_id, winner_id, chat_id)
+            await cycle_winners(user_id, winner_id, chat_id)
     except PSErrors.Error as e:
         print(e)
         await update.message.reply_text(STRINGS['user_not_found'])
@@ -0,0 +1,32 @@
+from typing import Optional, Tuple
+from telegram import ChatMember, Chat
+from telegram.error import BadRequest
+from kipubot.cache import MEMBER_CACHE_NEGATIVE_TTL, MISSING, admin_cache, member_cache
+
+
+async def get_chat_member_opt(chat: Chat, member_id: int) -> Optional[ChatMember]:
+    member = member_cache.get((chat.id, member_id))
+
+    if member is not MISSING:
+        return member
+
+    try:
+        member = await chat.get_member(member_id)
+    except BadRequest as e:
+        if e.message == 'User not found':
+            member_cache.put((chat.id, member_id), None, ttl=MEMBER_CACHE_NEGATIVE_TTL)
+            return None
+        raise e
+
+    member_cache.put((chat.id, member_id), member)
+    return member
+
+
+async def get_chat_administrators(chat: Chat) -> Tuple[ChatMember, ...]:
+    admins = admin_cache.get(chat.id)
+
+    if admins is MISSING:
+        admins = await chat.get_administrators()
+        admin_cache.put(chat.id, admins)
+
+    return admins
@@ -0,0 +1,89 @@
+import os
+import time
+import logging
+from functools import wraps
+from typing import Any, Awaitable, Callable, Dict, TypeVar
+from prometheus_client import Counter, Histogram, start_http_server
+from telegram.ext import BaseHandler, ConversationHandler
+from telegram.request import HTTPXRequest
+
+# serve metrics in the Prometheus text format on this port, disabled if unset
+METRICS_PORT = os.getenv('METRICS_PORT', default=None)
+METRICS_ADDR = os.getenv('METRICS_ADDR', default='0.0.0.0')
+
+T = TypeVar('T')
+
+# LOGGER
+_logger = logging.getLogger(__name__)
+
+HANDLER_LATENCY = Histogram('kipubot_handler_duration_seconds',
+                            'Time spent handling an update', ['handler'])
+HANDLER_CALLS = Counter('kipubot_handler_calls_total',
+                        'Updates handled', ['handler'])
+HANDLER_ERRORS = Counter('kipubot_handler_errors_total',
+                         'Updates whose handler raised an exception', ['handler'])
+RENDER_STAGE_LATENCY = Histogram('kipubot_render_stage_duration_seconds',
+                                 'Time spent in each stage of rendering a graph',
+                                 ['graph_type', 'stage'])
+BOT_API_CALLS = Counter('kipubot_bot_api_calls_total',
+                        'Bot API requests made', ['method'])
+BOT_API_ERRORS = Counter('kipubot_bot_api_errors_total',
+                         'Bot API requests that failed', ['method'])
+
+
+def start_metrics_server() -> None:
+    if METRICS_PORT:
+        _logger.info('Serving metrics on %s:%s', METRICS_ADDR, METRICS_PORT)
+        start_http_server(int(METRICS_PORT), addr=METRICS_ADDR)
+
+
+def observe_render(graph_type: str, stages: Dict[str, float]) -> None:
+    for stage, seconds in stages.items():
+        RENDER_STAGE_LATENCY.labels(graph_type, stage).observe(seconds)
+
+
+def timed(name: str, callback: Callable[..., Awaitable[T]]) -> Callable[..., Awaitable[T]]:
+    @wraps(callback)
+    async def wrapper(*args: Any, **kwargs: Any) -> T:
+        HANDLER_CALLS.labels(name).inc()
+        start = time.perf_counter()
+        try:
+            return await callback(*args, **kwargs)
+        except Exception:
+            HANDLER_ERRORS.labels(name).inc()
+            raise
+        finally:
+            HANDLER_LATENCY.labels(name).observe(time.perf_counter() - start)
+
+    return wrapper
+
+
+def instrument(handler: BaseHandler, name: str) -> BaseHandler:
+    # conversations are timed per state, as raffle_setup:<state>
+    if isinstance(handler, ConversationHandler):
+        for entry_point in handler.entry_points:
+            instrument(entry_point, f'{name}:entry')
+        for state, state_handlers in handler.states.items():
+            state_name = ('timeout' if state == ConversationHandler.TIMEOUT
+                          else str(state).rsplit(':', 1)[-1])
+            for state_handler in state_handlers:
+                instrument(state_handler, f'{name}:{state_name}')
+        for fallback in handler.fallbacks:
+            instrument(fallback, f'{name}:fallback')
+    else:
+        handler.callback = timed(name, handler.callback)
+
+    return handler
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """Counts the Bot API calls and failures made through it by method."""
+
+    async def post(self, url: str, *args: Any, **kwargs: Any) -> Any:
+        method = url.rsplit('/', 1)[-1]
+        BOT_API_CALLS.labels(method).inc()
+        try:
+            return await super().post(url, *args, **kwargs)
+        except Exception:
+            BOT_API_ERRORS.labels(method).inc()
+            raise
@@ -0,0 +1,120 @@
+import os
+import json
+import pickle
+import hashlib
+from typing import Any, Dict, Optional
+from telegram.ext import BasePersistence, PersistenceInput
+from telegram.ext._utils.types import CDCData, ConversationDict, ConversationKey
+from kipubot import db
+from kipubot.cache import MISSING, TTLCache
+
+# users whose stored data is remembered, so their unchanged data isn't written again
+PERSISTENCE_CACHE_MAX_SIZE = int(os.getenv('PERSISTENCE_CACHE_MAX_SIZE', default='10000'))
+
+
+def _digest(data: bytes) -> bytes:
+    return hashlib.sha256(data).digest()
+
+
+class PostgresPersistence(BasePersistence):
+    """Stores user data and conversation states as rows in Postgres.
+
+    User data is loaded lazily the first time it's needed, and written only
+    when it differs from what was last loaded or saved. Users without data
+    have no row. Bot data, chat data and callback data aren't stored.
+    """
+
+    def __init__(self, url: str, update_interval: float = 60) -> None:
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=False,
+                                                     callback_data=False),
+                         update_interval=update_interval)
+        self._url = url
+        # user_id -> digest of the stored data of the recently seen users, None if there's no row
+        self._digests = TTLCache(PERSISTENCE_CACHE_MAX_SIZE, float('inf'))
+
+    async def _refresh(self, kind: str, data_id: int, data: Dict[Any, Any]) -> None:
+        # the in-memory copy is up to date after the first load, and
+        # data in memory is newer than the stored data of an evicted user
+        if data or self._digests.get((kind, data_id)) is not MISSING:
+            return
+
+        stored = await db.get_persistence_data(kind, data_id)
+        if stored is not None:
+            data.update(pickle.loads(stored))
+        self._digests.put((kind, data_id), None if stored is None else _digest(stored))
+
+    async def _update(self, kind: str, data_id: int, data: Dict[Any, Any]) -> None:
+        # every user of every update is passed here, mostly unchanged and empty
+        pickled = pickle.dumps(data) if data else None
+        digest = None if pickled is None else _digest(pickled)
+        if self._digests.get((kind, data_id)) == digest:
+            return
+
+        if pickled is None:
+            await db.delete_persistence_data(kind, data_id)
+        else:
+            await db.save_persistence_data(kind, data_id, pickled)
+        self._digests.put((kind, data_id), digest)
+
+    async def _drop(self, kind: str, data_id: int) -> None:
+        await db.delete_persistence_data(kind, data_id)
+        self._digests.invalidate((kind, data_id))
+
+    # the application loads its persistence before post_init runs,
+    # so the getters called at startup open the pool themselves
+
+    # nothing is loaded up front, see refresh_user_data
+    async def get_user_data(self) -> Dict[int, Dict[Any, Any]]:
+        await db.open_pool(self._url)
+        return {}
+
+    async def get_chat_data(self) -> Dict[int, Dict[Any, Any]]:
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict[Any, Any]) -> None:
+        await self._refresh('user', user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict[Any, Any]) -> None:
+        pass
+
+    async def update_user_data(self, user_id: int, data: Dict[Any, Any]) -> None:
+        await self._update('user', user_id, data)
+
+    async def update_chat_data(self, chat_id: int, data: Dict[Any, Any]) -> None:
+        pass
+
+    async def drop_user_data(self, user_id: int) -> None:
+        await self._drop('user', user_id)
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def get_conversations(self, name: str) -> ConversationDict:
+        await db.open_pool(self._url)
+        return {tuple(json.loads(key)): pickle.loads(state)
+                for key, state in await db.get_conversation_states(name)}
+
+    async def update_conversation(self, name: str, key: ConversationKey,
+                                  new_state: Optional[object]) -> None:
+        await db.save_conversation_state(
+            name, json.dumps(key), None if new_state is None else pickle.dumps(new_state))
+
+    async def get_bot_data(self) -> Dict[Any, Any]:
+        return {}
+
+    async def update_bot_data(self, data: Dict[Any, Any]) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: Dict[Any, Any]) -> None:
+        pass
+
+    async def get_callback_data(self) -> Optional[CDCData]:
+        return None
+
+    async def update_callback_data(self, data: CDCData) -> None:
+        pass
+
+    async def flush(self) -> None:
+        # called last as the application stops, the data is already written but
+        # queued registrations aren't, closing the pool writes them
+        await db.close_pool()
@@ -0,0 +1,130 @@
+import os
+import time
+import logging
+from contextvars import ContextVar
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict
+import psycopg
+from psycopg import pq
+
+# record the latency, row count and call count of DB queries per db function
+DB_PROFILE = os.getenv('DB_PROFILE', default='0') == '1'
+# queries slower than this many milliseconds are logged with their EXPLAIN (ANALYZE) plan
+DB_SLOW_QUERY_MS = float(os.getenv('DB_SLOW_QUERY_MS', default='100'))
+
+# name of the db function whose queries are running
+current_function: 'ContextVar[str]' = ContextVar('current_function', default='<unknown>')
+
+# LOGGER
+_logger = logging.getLogger(__name__)
+
+
+class FunctionStats:  # pylint: disable=too-few-public-methods
+    __slots__ = ('calls', 'seconds', 'max_seconds', 'queries', 'query_seconds', 'rows')
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.rows = 0
+
+
+_stats: Dict[str, FunctionStats] = {}
+
+
+def record_call(function: str, seconds: float) -> None:
+    # a whole db function call, including waiting for a pooled connection
+    stats = _stats.setdefault(function, FunctionStats())
+    stats.calls += 1
+    stats.seconds += seconds
+    stats.max_seconds = max(stats.max_seconds, seconds)
+
+
+def record_query(function: str, seconds: float, rows: int) -> None:
+    stats = _stats.setdefault(function, FunctionStats())
+    stats.queries += 1
+    stats.query_seconds += seconds
+    stats.rows += max(rows, 0)
+
+
+def reset() -> None:
+    _stats.clear()
+
+
+def report() -> str:
+    lines = [f'{"function":<28}{"calls":>8}{"total ms":>12}{"mean ms":>10}{"max ms":>10}'
+             f'{"queries":>9}{"query ms":>12}{"rows":>10}']
+
+    for function, stats in sorted(_stats.items(), key=lambda item: -item[1].seconds):
+        mean = stats.seconds / stats.calls if stats.calls else 0.0
+        lines.append(f'{function:<28}{stats.calls:>8}{stats.seconds * 1000:>12.1f}'
+                     f'{mean * 1000:>10.2f}{stats.max_seconds * 1000:>10.2f}'
+                     f'{stats.queries:>9}{stats.query_seconds * 1000:>12.1f}{stats.rows:>10}')
+
+    return '\n'.join(lines)
+
+
+def log_report() -> None:
+    _logger.info('DB profile:\n%s', report())
+
+
+class ProfilingCursor(psycopg.AsyncCursor):
+    """Cursor that records every query and COPY it runs and explains slow queries."""
+
+    async def execute(self, query: Any, params: Any = None, **kwargs: Any) -> Any:
+        start = time.perf_counter()
+        await super().execute(query, params, **kwargs)
+        seconds = time.perf_counter() - start
+
+        function = current_function.get()
+        record_query(function, seconds, self.rowcount)
+
+        if seconds * 1000 >= DB_SLOW_QUERY_MS and isinstance(query, str):
+            await _log_slow_query(self.connection, function, query, params, seconds)
+
+        return self
+
+    @asynccontextmanager
+    async def copy(self, statement: Any, params: Any = None,
+                   **kwargs: Any) -> AsyncIterator[psycopg.AsyncCopy]:
+        # a COPY can't be explained, it's only timed
+        # pylint: disable=contextmanager-generator-missing-cleanup
+        start = time.perf_counter()
+        try:
+            async with super().copy(statement, params, **kwargs) as copy:
+                yield copy
+        finally:
+            record_query(current_function.get(), time.perf_counter() - start, self.rowcount)
+
+
+async def _log_slow_query(con: psycopg.AsyncConnection, function: str, query: str,
+                          params: Any, seconds: float) -> None:
+    # the plan is analyzed by running the query again, so any changes it makes
+    # are rolled back to a savepoint, and a failing EXPLAIN doesn't break the caller.
+    # a plain cursor runs it, so the EXPLAIN itself isn't recorded
+    try:
+        async with con.transaction(force_rollback=True):
+            cur = psycopg.AsyncCursor(con)
+            await cur.execute(f'EXPLAIN (ANALYZE) {query}', params)
+            plan = '\n'.join(row[0] for row in await cur.fetchall())
+    except psycopg.Error as e:
+        plan = f'EXPLAIN failed: {e}'
+
+    _logger.warning('Slow query in %s took %.1f ms:\n%s\n%s',
+                    function, seconds * 1000, query, plan)
+
+
+class ProfilingConnection(psycopg.AsyncConnection):
+    """Connection whose cursors, and so queries run with execute, are profiled."""
+
+    def cursor(self, name: str = '', *, binary: bool = False, **kwargs: Any) -> Any:
+        # named cursors are server-side and aren't profiled
+        if name:
+            return super().cursor(name, binary=binary, **kwargs)
+
+        cur = ProfilingCursor(self, row_factory=kwargs.get('row_factory') or self.row_factory)
+        if binary:
+            cur.format = pq.Format.BINARY
+        return cur
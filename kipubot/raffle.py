@@ -0,0 +1,125 @@
+from typing import Collection, NamedTuple
+import numpy as np
+import pandas as pd
+
+# microseconds from the unix epoch to the postgres epoch, 2000-01-01
+_PG_EPOCH_US = 946_684_800 * 1_000_000
+
+# an entry packed by db.get_raffle_data, as big-endian 64-bit integers
+_PACKED_ENTRY = np.dtype([(field, '>i8') for field in
+                          ('date', 'amount', 'pool', 'entrants', 'next_expected')])
+
+
+class RaffleSeries(NamedTuple):
+    pool: np.ndarray
+    entrants: np.ndarray
+    win_odds: np.ndarray
+    next_expected: np.ndarray
+
+
+class SeriesState(NamedTuple):
+    # where the series of the stored entries left off
+    pool: int = 0
+    entrants: int = 0
+    seen_names: Collection[str] = ()
+
+
+class RaffleEntries(NamedTuple):
+    """Entries in date order, with the series derived from the entries up to each one."""
+    dates: np.ndarray
+    amounts: np.ndarray
+    pool: np.ndarray
+    entrants: np.ndarray
+    next_expected: np.ndarray
+
+
+def derive_series(names: np.ndarray,
+                  amounts: np.ndarray,
+                  entry_fee: int,
+                  state: SeriesState = SeriesState()) -> RaffleSeries:
+    # entries in date order, continuing after the stored ones
+    first_entry = ~pd.Index(names).duplicated()
+    if len(state.seen_names) > 0:
+        first_entry &= ~pd.Index(names).isin(list(state.seen_names))
+
+    pool = np.cumsum(amounts, dtype=np.int64) + state.pool
+    entrants = np.cumsum(first_entry, dtype=np.int64) + state.entrants
+    # the entrant of the first entry is always new, so there's no division by zero
+    win_odds = 1.0 / entrants
+    next_expected = np.rint(- entry_fee * (1 - win_odds)
+                            + (pool - entry_fee) * win_odds).astype(np.int64)
+
+    return RaffleSeries(pool, entrants, win_odds, next_expected)
+
+
+def entries_from_df(df: pd.DataFrame, entry_fee: int) -> RaffleEntries:
+    # entries with the same date keep their order
+    order = np.argsort(df['date'].values, kind='stable')
+    amounts = df['amount'].values.astype(np.int64)[order]
+    series = derive_series(df['name'].values[order], amounts, entry_fee)
+
+    return RaffleEntries(df['date'].values.astype('datetime64[ns]')[order], amounts,
+                         series.pool, series.entrants, series.next_expected)
+
+
+def entries_from_bytes(data: bytes) -> RaffleEntries:
+    # dates are microseconds since 2000, like postgres stores timestamps
+    rows = np.frombuffer(data, dtype=_PACKED_ENTRY)
+
+    dates = rows['date'].astype(np.int64)
+    dates += _PG_EPOCH_US
+    dates *= 1000
+
+    return RaffleEntries(dates.view('datetime64[ns]'),
+                         rows['amount'].astype(np.int64),
+                         rows['pool'].astype(np.int64),
+                         rows['entrants'].astype(np.int64),
+                         rows['next_expected'].astype(np.int64))
+
+
+def format_dates(dates: np.ndarray) -> np.ndarray:
+    # ISO 8601 to the microsecond, which is all postgres keeps
+    return np.datetime_as_string(dates.astype('datetime64[us]'), unit='us')
+
+
+def with_bounds(first: int, values: np.ndarray, *rest: int) -> np.ndarray:
+    # values with one value in front and the rest after them, in a single allocation
+    out = np.empty(values.size + 1 + len(rest), dtype=np.int64)
+    out[0] = first
+    out[1:values.size + 1] = values
+    out[values.size + 1:] = rest
+    return out
+
+
+def lttb(x: np.ndarray, y: np.ndarray, threshold: int) -> np.ndarray:
+    # indices of the points Largest-Triangle-Three-Buckets keeps of a series,
+    # which always include the first and the last point
+    n = x.size
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    # relative to the first point, as float nanosecond timestamps lose precision
+    x = (x - x[0]).astype(np.float64)
+    y = y.astype(np.float64)
+
+    # the points between the first and the last are split into threshold - 2 buckets,
+    # each point is compared with the average of the bucket after it
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    counts = np.diff(edges)
+    avg_x = np.append(np.add.reduceat(x, edges[:-1]) / counts, x[-1])
+    avg_y = np.append(np.add.reduceat(y, edges[:-1]) / counts, y[-1])
+
+    kept = np.empty(threshold, dtype=np.int64)
+    kept[0], kept[-1] = 0, n - 1
+    a = 0
+
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        # twice the area of the triangle from the last kept point
+        # to each point in the bucket and the next bucket's average
+        area = np.abs((x[a] - avg_x[i + 1]) * (y[start:end] - y[a])
+                      - (x[a] - x[start:end]) * (avg_y[i + 1] - y[a]))
+        a = start + int(np.argmax(area))
+        kept[i + 1] = a
+
+    return kept
@@ -0,0 +1,106 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+# render in worker 'process'es or, as renders share no state, 'thread's
+RENDER_EXECUTOR = os.getenv('RENDER_EXECUTOR', default='process')
+# number of workers rendering graphs
+RENDER_WORKERS = int(os.getenv('RENDER_WORKERS', default=str(os.cpu_count() or 1)))
+# seconds a single render may take before it's given up on
+RENDER_TIMEOUT = float(os.getenv('RENDER_TIMEOUT', default='30'))
+
+# STORE RENDER POOL
+_EXECUTOR: Optional[Executor] = None
+
+# durations of the stages of the render running in this thread
+_stages = threading.local()
+
+# LOGGER
+_logger = logging.getLogger(__name__)
+
+
+@contextmanager
+def render_stage(name: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stages = getattr(_stages, 'durations', None)
+        if stages is not None:
+            stages[name] = stages.get(name, 0.0) + time.perf_counter() - start
+
+
+def _render_timed(render_func: Callable[..., bytes], *args: Any) -> Tuple[bytes, Dict[str, float]]:
+    _stages.durations = {}
+    try:
+        return render_func(*args), _stages.durations
+    finally:
+        _stages.durations = None
+
+
+def get_executor() -> Executor:
+    global _EXECUTOR  # pylint: disable=global-statement
+
+    if _EXECUTOR is None:
+        _logger.info('Starting render %s pool with %d workers...',
+                     RENDER_EXECUTOR, RENDER_WORKERS)
+
+        if RENDER_EXECUTOR == 'thread':
+            _EXECUTOR = ThreadPoolExecutor(max_workers=RENDER_WORKERS,
+                                           thread_name_prefix='render')
+        else:
+            # the bot already runs threads of its own by now, and forking
+            # a process with threads can deadlock on locks they held
+            method = ('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods()
+                      else 'spawn')
+            _EXECUTOR = ProcessPoolExecutor(max_workers=RENDER_WORKERS,
+                                            mp_context=multiprocessing.get_context(method))
+
+    return _EXECUTOR
+
+
+def _stop_stuck_workers() -> None:
+    # worker processes don't stop rendering when they're given up on, so the pool
+    # is replaced with its workers terminated, renders still running in it fail.
+    # threads can't be stopped, so a thread pool is kept and only the waiting stops
+    if isinstance(_EXECUTOR, ProcessPoolExecutor):
+        for process in list(_EXECUTOR._processes.values()):  # pylint: disable=protected-access
+            process.terminate()
+        shutdown_executor()
+
+
+def shutdown_executor() -> None:
+    global _EXECUTOR  # pylint: disable=global-statement
+
+    if _EXECUTOR is not None:
+        _EXECUTOR.shutdown(wait=False)
+        _EXECUTOR = None
+
+
+async def render(render_func: Callable[..., bytes],
+                 *args: Any) -> Tuple[bytes, Dict[str, float]]:
+    # with a process pool render_func and its args are pickled to a worker,
+    # so they must be module level functions and picklable values.
+    # returns the image and the seconds spent in each render_stage
+    loop = asyncio.get_running_loop()
+
+    try:
+        return await asyncio.wait_for(
+            loop.run_in_executor(get_executor(), _render_timed, render_func, *args),
+            timeout=RENDER_TIMEOUT)
+    except asyncio.TimeoutError:
+        _logger.warning('Render timed out after %s s', RENDER_TIMEOUT)
+        _stop_stuck_workers()
+        raise
+    except BrokenProcessPool:
+        # a worker died, start a fresh pool for the next render
+        _logger.error('Render pool broke, restarting it on next render')
+        shutdown_executor()
+        raise
@@ -1,27 +1,38 @@
 import os
 import re
-from typing import NamedTuple, Optional
+from datetime import datetime
+from threading import Lock
+from contextlib import contextmanager
+from zipfile import BadZipFile
+from typing import BinaryIO, Dict, Iterator, List, NamedTuple, Optional, Tuple, Union
 import pytz
-import matplotlib.pyplot as plt
+from openpyxl import load_workbook
+from openpyxl.utils.exceptions import InvalidFileException
+from matplotlib.figure import Figure
+from matplotlib.axes import Axes
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import matplotlib.dates as mdates
 from matplotlib.ticker import AutoMinorLocator
 import pandas as pd
 import numpy as np
 from scipy import stats
-from scipy.optimize import curve_fit
-import uncertainties as unc
-import uncertainties.unumpy as unp
-from telegram import ChatMember, Chat
-from telegram.error import BadRequest
-from kipubot.errors import NoRaffleError
+from kipubot.errors import NoRaffleError, InvalidExcelError
 from kipubot import db
+from kipubot.render import render_stage
+from kipubot.encoding import ImageFormat, encode, image_format
+from kipubot.raffle import RaffleEntries, lttb, with_bounds
+
+# plotted points per horizontal pixel of a graph, longer series are downsampled
+PLOT_POINTS_PER_PIXEL = float(os.getenv('PLOT_POINTS_PER_PIXEL', default='1'))
+# points the regression lines are drawn with
+REGRESSION_GRID_SIZE = 100
 
 
 class RaffleData(NamedTuple):
     start_date: pd.Timestamp
     end_date: pd.Timestamp
     entry_fee: int
-    df: Optional[pd.DataFrame]
+    entries: Optional[RaffleEntries]
 
 
 def is_int(x: str) -> bool:
@@ -57,61 +68,47 @@ def int_price_to_str(num: int) -> str:
     return str_num
 
 
-async def get_chat_member_opt(chat: Chat, member_id: int) -> Optional[ChatMember]:
-    try:
-        return await chat.get_member(member_id)
-    except BadRequest as e:
-        if e.message == 'User not found':
-            return None
-        raise e
-
-
-def preband(x, xd, yd, p, func):
-    conf = 0.95
-    alpha = 1.0 - conf
-    quantile = stats.t.ppf(1.0 - alpha / 2.0, xd.size - len(p))
-    stdev = np.sqrt(1. / (xd.size - len(p)) * np.sum((yd - func(xd, *p))**2))
-    # auxiliary definitions
-    sx = (x - xd.mean()) ** 2
-    sxd = np.sum((xd - xd.mean()) ** 2)
-    # predicted values (best-fit model)
-    yp = func(x, *p)
-    # prediction band
-    dy = quantile * stdev * np.sqrt(1.0 + 1.0 / xd.size + sx / sxd)
-    # upper & lower
-    lpb, upb = yp - dy, yp + dy
-    return lpb, upb
-
-
-def fit_timedata(x_series: "pd.Series[np.int64]", y_series: "pd.Series[np.int64]"):  # pylint: disable=too-many-locals
+def fit_timedata(x_series: np.ndarray,  # pylint: disable=too-many-locals
+                 y_series: np.ndarray,
+                 grid_size: int = REGRESSION_GRID_SIZE):
+    x_series = np.asarray(x_series)
+    y_series = np.asarray(y_series)
     # ignore the end date in curve fitting
-    x = x_series.values[:-1]
-    y = y_series.values[:-1]
-
-    def f(x, slope, intercept):
-        return slope * x + intercept
-
-    # pylint: disable=unbalanced-tuple-unpacking
-    popt, pcov = curve_fit(f, x, y)
-
-    a, b = unc.correlated_values(popt, pcov)
-
-    # calculate regression confidence interval
+    x = x_series[:-1]
+    y = y_series[:-1]
+    n = x.size
+
+    # least squares fit of y = a*x + b in closed form, centering x first,
+    # as the sums of squared nanosecond timestamps would lose all precision
+    x_mean = x.mean()
+    x_centered = x - x_mean
+    sxx = np.dot(x_centered, x_centered)
+    a = np.dot(x_centered, y - y.mean()) / sxx
+    b = y.mean() - a * x_mean
+
+    # residual standard deviation, 2 degrees of freedom go to a and b
+    dof = n - 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        stdev = np.sqrt(np.sum((y - (a * x + b)) ** 2) / dof)
+    quantile = stats.t.ppf(0.975, dof)
 
     # if cur time later than raffle end date, use the end date
     now = get_cur_time_hel().value
     end = x_series[-2] if now >= x_series[-1] else x_series[-1]
 
-    px = np.linspace(x_series[0], end,
-                     y_series.size - 1, dtype=np.int64)
-    py = a*px+b
-    nom = unp.nominal_values(py)
-    std = unp.std_devs(py)
+    px = np.linspace(x_series[0], end, grid_size, dtype=np.int64)
+    nom = a * px + b
 
-    lpb, upb = preband(px, x, y, popt, f)
+    # leverage of each px, the variance of a*px+b is stdev**2 * leverage
+    leverage = 1.0 / n + (px - x_mean) ** 2 / sxx
+    # regression standard error
+    std = stdev * np.sqrt(leverage)
+    # 95% prediction band
+    dy = quantile * stdev * np.sqrt(1.0 + leverage)
+    lpb, upb = nom - dy, nom + dy
 
     # convert back to dates
-    px = [pd.to_datetime(x, unit='ns') for x in px]
+    px = px.view('datetime64[ns]')
 
     return (px, nom, std, lpb, upb)
 
@@ -126,42 +123,83 @@ def remove_emojis(text: str) -> str:
     return emojis.sub(r' ', text)
 
 
-def validate_excel(excel_path: str) -> bool:
-    df = pd.read_excel(excel_path, usecols='A,B,D', header=None, names=[
-        'date', 'name', 'amount'], parse_dates=True)
-    return (df.size > 0 and
-            df['date'].dtype == 'datetime64[ns]' and
-            df['name'].dtype == 'object' and
-            df['amount'].dtype in ('int64', 'float64'))
+def parse_excel(excel_file: Union[str, BinaryIO],
+                start_date: Optional[pd.Timestamp] = None,
+                end_date: Optional[pd.Timestamp] = None) -> Optional[pd.DataFrame]:
+    # validates, filters and converts a MobilePay export in a single
+    # streaming pass, returns None if the file isn't a valid export
+    try:
+        wb = load_workbook(excel_file, read_only=True, data_only=True)
+    except (InvalidFileException, BadZipFile, KeyError):
+        return None
+
+    dates, names, amounts = [], [], []
+    row_count = 0
+
+    try:
+        ws = wb.worksheets[0]
+        # exports may have wrong sheet dimensions, which read-only mode trusts
+        ws.reset_dimensions()
+
+        # columns: date, name, message, amount
+        for row in ws.iter_rows(max_col=4, values_only=True):
+            date, name, _, amount = row + (None,) * (4 - len(row))
+
+            if date is None and name is None and amount is None:
+                continue
+
+            if (not isinstance(date, datetime) or
+                    isinstance(amount, bool) or
+                    not isinstance(amount, (int, float))):
+                return None
+
+            row_count += 1
+
+            if (amount <= 0 or
+                    (start_date is not None and date < start_date) or
+                    (end_date is not None and date > end_date)):
+                continue
+
+            dates.append(date)
+            names.append(name)
+            amounts.append(round(amount * 100))
+    finally:
+        wb.close()
+
+    if row_count == 0:
+        return None
+
+    return pd.DataFrame({'date': pd.to_datetime(dates),
+                         'name': pd.Series(names, dtype=object),
+                         'amount': np.array(amounts, dtype=np.int64)})
+
+
+def filter_by_date(df: pd.DataFrame,
+                   start_date: pd.Timestamp,
+                   end_date: pd.Timestamp) -> pd.DataFrame:
+    return df[(df['date'] >= start_date) & (df['date'] <= end_date)]
 
 
 def read_excel_to_df(excel_path: str,
                      start_date: pd.Timestamp,
                      end_date: pd.Timestamp) -> pd.DataFrame:
-    df = pd.read_excel(excel_path, usecols='A,B,D', header=None, names=[
-        'date', 'name', 'amount'], parse_dates=True)
-    df.drop(df[df['amount'] <= 0].index, inplace=True)
-    df.drop(df[df['date'] > end_date].index, inplace=True)
-    df.drop(df[df['date'] < start_date].index, inplace=True)
-    df['amount'] = df['amount'] * 100
+    df = parse_excel(excel_path, start_date, end_date)
+
+    if df is None:
+        raise InvalidExcelError(f'Invalid Excel file {excel_path}')
+
     return df
 
 
-def get_raffle(chat_id: int, include_df: bool = False) -> RaffleData:
-    query_result = db.get_raffle_data(chat_id)
+async def get_raffle(chat_id: int, include_entries: bool = False) -> RaffleData:
+    query_result = await db.get_raffle_data(chat_id)
 
     if query_result is None:
         raise NoRaffleError(f'No raffle found for chat {chat_id}')
 
-    _, start_date, end_date, entry_fee, dates, entries, amounts = query_result
-
-    if include_df:
-        df = pd.DataFrame(
-            data={'date': dates, 'name': entries, 'amount': amounts})
-        df.set_index('date', inplace=True)
-        return RaffleData(start_date, end_date, entry_fee, df)
+    _, start_date, end_date, entry_fee, entries = query_result
 
-    return RaffleData(start_date, end_date, entry_fee, None)
+    return RaffleData(start_date, end_date, entry_fee, entries if include_entries else None)
 
 
 def get_cur_time_hel() -> pd.Timestamp:
@@ -173,140 +211,187 @@ def get_cur_time_hel() -> pd.Timestamp:
     return cur_time_hel
 
 
-def save_raffle(chat_id: int,
-                start_date: pd.Timestamp,
-                end_date: pd.Timestamp,
-                entry_fee: int,
-                df: pd.DataFrame) -> None:
-    db.save_raffle_data(chat_id, start_date, end_date, entry_fee, df)
+async def save_raffle(chat_id: int,
+                      start_date: pd.Timestamp,
+                      end_date: pd.Timestamp,
+                      entry_fee: int,
+                      df: pd.DataFrame) -> None:
+    await db.save_raffle_data(chat_id, start_date, end_date, entry_fee, df)
 
 
-def parse_df_essentials(raffle_data: RaffleData) -> RaffleData:
-    start_date, end_date, fee, df = raffle_data
+async def append_raffle(chat_id: int, df: pd.DataFrame) -> int:
+    return await db.append_raffle_data(chat_id, df)
 
-    df.at[start_date, 'amount'] = 0
 
-    df['datenum'] = pd.to_numeric(df.index.values)
-    df = df.sort_values('datenum')
-    df['amount'] = df['amount'].cumsum().astype(int)
-    df['unique'] = (~df['name'].duplicated()).cumsum() - 1
+def parse_expected(raffle_data: RaffleData) -> Tuple[np.ndarray, np.ndarray]:
+    # dates as nanoseconds and the expected value of the next entry,
+    # which is zero at the start date
+    start_date, _, _, entries = raffle_data
 
-    return RaffleData(start_date, end_date, fee, df)
+    return (with_bounds(pd.Timestamp(start_date).value, entries.dates.view(np.int64)),
+            with_bounds(0, entries.next_expected))
 
 
-def parse_expected(raffle_data: RaffleData) -> RaffleData:
-    start_date, end_date, entry_fee, df = parse_df_essentials(raffle_data)
+def parse_graph(raffle_data: RaffleData) -> Tuple[np.ndarray, np.ndarray]:
+    # dates as nanoseconds and the pool, which starts empty at the start date
+    # and stays as it is after the last entry until now and the end date
+    start_date, end_date, _, entries = raffle_data
+    last_pool = int(entries.pool[-1]) if entries.pool.size > 0 else 0
+    now, end = sorted((get_cur_time_hel().value, pd.Timestamp(end_date).value))
 
-    df['win_odds'] = 1.0 / df['unique']
-    df['next_expected'] = ((- entry_fee * (1 - df['win_odds'])
-                           + (df['amount'] - entry_fee) * df['win_odds'])
-                           ).fillna(0).round().astype(int)
+    return (with_bounds(pd.Timestamp(start_date).value, entries.dates.view(np.int64), now, end),
+            with_bounds(0, entries.pool, last_pool, last_pool))
 
-    return RaffleData(start_date, end_date, entry_fee, df)
 
+def new_plot(figsize: Optional[Tuple[float, float]] = None,
+             dpi: Optional[float] = None) -> Tuple[Figure, Axes]:
+    # figures are created without pyplot, so no global state is shared
+    # between renders and they can safely run in parallel threads
+    fig = Figure(figsize=figsize, dpi=dpi)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
 
-def parse_graph(raffle_data: RaffleData) -> RaffleData:
-    df = raffle_data.df
+    return fig, ax
 
-    df.at[get_cur_time_hel(), 'amount'] = 0
-    df.at[raffle_data.end_date, 'amount'] = 0
 
-    parsed_raffle_data = parse_df_essentials(
-        raffle_data._replace(df=df))
+def downsample(fig: Figure, x: np.ndarray, y: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # at most PLOT_POINTS_PER_PIXEL points per pixel of the figure's width,
+    # with the nanosecond x values as dates
+    with render_stage('downsample'):
+        budget = int(fig.get_figwidth() * fig.dpi * PLOT_POINTS_PER_PIXEL)
+        kept = lttb(x, y, budget)
 
-    return parsed_raffle_data
+    return x[kept].view('datetime64[ns]'), y[kept]
 
 
-def configure_and_save_plot(out_img_path: str) -> None:
-    ax = plt.gca()
+def save_plot(fig: Figure, ax: Axes, graph_type: str) -> bytes:
+    with render_stage('plot'):
+        # the legend lists the lines of this render
+        ax.legend()
 
-    # toggle legend
-    ax.legend()
+    with render_stage('encode'):
+        return encode(fig, GRAPH_IMAGE_FORMATS[graph_type])
 
+
+def _configure_plot(fig: Figure, ax: Axes) -> None:
     # format axis
     ax.xaxis.set_major_formatter(mdates.DateFormatter('%d.%m. %H:%M'))
     ax.yaxis.set_major_formatter(lambda x, _: int_price_to_str(x))
+    fig.autofmt_xdate()
 
     # set grid
     ax.xaxis.set_minor_locator(AutoMinorLocator(2))
     ax.yaxis.set_minor_locator(AutoMinorLocator(2))
-    plt.grid(visible=True, which='major',
-             axis='both', linestyle='--', linewidth=0.5)
+    ax.grid(visible=True, which='major',
+            axis='both', linestyle='--', linewidth=0.5)
 
-    if not os.path.exists(os.path.dirname(out_img_path)):
-        os.makedirs(os.path.dirname(out_img_path))
 
-    plt.savefig(out_img_path)
-    plt.clf()
+class FigureTemplate:  # pylint: disable=too-few-public-methods
+    """A styled figure of one graph type, whose data is replaced on each render."""
 
+    def __init__(self, ylabel: str, fmt: ImageFormat) -> None:
+        self.fig, self.ax = new_plot(fmt.size, fmt.dpi)
+        _configure_plot(self.fig, self.ax)
+        self.ax.set_ylabel(ylabel)
 
-def generate_graph(out_img_path: str,
-                   chat_id: int,
-                   chat_title: str) -> None:
+    def reset(self) -> None:
+        for line in list(self.ax.get_lines()):
+            line.remove()
 
-    # -- get raffle data --
-    raffle_data = get_raffle(chat_id, include_df=True)
+        legend = self.ax.get_legend()
+        if legend is not None:
+            legend.remove()
 
-    # -- parse and fit data --
-    start_date, end_date, _, df = parse_graph(raffle_data)
-    px, nom, std, lpb, upb = fit_timedata(df['datenum'], df['amount'])
+        self.ax.set_prop_cycle(None)
 
-    # -- plot --
-    # clear previous plot in case of leftovers
-    plt.clf()
-    ax = plt.gca()
-    # plot data
-    df['amount'][:-1].plot(ax=ax, marker='o', style='r', label='Pool')
-    # plot regression
-    ax.plot(px, nom, '-', color='black', label='y=ax+b')
-    # uncertainty lines (95% conf)
-    ax.plot(px, nom-1.96*std, c='orange', label='95% confidence region')
-    ax.plot(px, nom+1.96*std, c='orange')
-    # prediction band (95% conf)
-    ax.plot(px, lpb, 'k--', label='95% prediction band')
-    ax.plot(px, upb, 'k--')
-
-    # -- style graph --
-    pred_max_pool = (nom+1.96*std)[-1]
-    pool_total = df['amount'].max()
-    plt.ylim(0, max(pred_max_pool, pool_total))
-    plt.xlim((pd.to_datetime(start_date), pd.to_datetime(end_date)))
-
-    plt.title(str(remove_emojis(chat_title).strip()) + "\n" +
-              f"Entries {df['unique'].max()} | Pool {int_price_to_str(pool_total)} €")
-    plt.xlabel(None)
-    plt.ylabel('Pool (€)')
-
-    configure_and_save_plot(out_img_path)
-
-
-def generate_expected(out_img_path: str,
-                      chat_id: int,
-                      chat_title: str) -> None:
-
-    # -- get raffle data --
-    raffle_data = get_raffle(chat_id, include_df=True)
 
-    # -- parse and fit data --
-    start_date, _, entry_fee, df = parse_expected(raffle_data)
+# y axis label of each graph type
+GRAPH_YLABELS = {'graph': 'Pool (€)', 'expected': 'Expected Value (€)'}
+# size and encoding of each graph type's images
+GRAPH_IMAGE_FORMATS = {graph_type: image_format(graph_type) for graph_type in GRAPH_YLABELS}
 
-    # -- plot --
-    # clear previous plot in case of leftovers
-    plt.clf()
-    ax = plt.gca()
+_free_templates: Dict[str, List[FigureTemplate]] = {}
+_templates_lock = Lock()
+
+
+@contextmanager
+def figure_template(graph_type: str) -> Iterator[Tuple[Figure, Axes]]:
+    # a free template of the graph type, or a new one if all are in use,
+    # templates of failed renders aren't reused as their state is unknown
+    with _templates_lock:
+        free = _free_templates.setdefault(graph_type, [])
+        template = free.pop() if free else None
 
-    df['next_expected'].plot(
-        ax=ax, marker='o', style='r', label='Expected Value')
+    if template is None:
+        template = FigureTemplate(GRAPH_YLABELS[graph_type], GRAPH_IMAGE_FORMATS[graph_type])
 
-    # -- style graph --
-    plt.ylim(float(int_price_to_str((df['next_expected'].min() - 100) * 110)),
-             float(int_price_to_str((df['next_expected'].max() + 100) * 110)))
-    plt.xlim((pd.to_datetime(start_date), pd.to_datetime(get_cur_time_hel())))
+    yield template.fig, template.ax
 
-    plt.title(str(remove_emojis(chat_title).strip()) +
-              f' | Fee {int_price_to_str(entry_fee)} €\n' +
-              f"Expected Value { int_price_to_str(df['next_expected'].iloc[-1])} €")
-    plt.xlabel(None)
-    plt.ylabel('Expected Value (€)')
+    template.reset()
+    with _templates_lock:
+        free.append(template)
 
-    configure_and_save_plot(out_img_path)
+
+def clear_figure_templates() -> None:
+    with _templates_lock:
+        _free_templates.clear()
+
+
+def generate_graph(raffle_data: RaffleData, chat_title: str) -> bytes:
+    # -- parse and fit data --
+    with render_stage('parse'):
+        x, pool = parse_graph(raffle_data)
+    with render_stage('fit'):
+        px, nom, std, lpb, upb = fit_timedata(x, pool)
+
+    # -- plot --
+    with figure_template('graph') as (fig, ax):
+        with render_stage('plot'):
+            # plot data
+            ax.plot(*downsample(fig, x[:-1], pool[:-1]), 'r', marker='o', label='Pool')
+            # plot regression
+            ax.plot(px, nom, '-', color='black', label='y=ax+b')
+            # uncertainty lines (95% conf)
+            ax.plot(px, nom-1.96*std, c='orange', label='95% confidence region')
+            ax.plot(px, nom+1.96*std, c='orange')
+            # prediction band (95% conf)
+            ax.plot(px, lpb, 'k--', label='95% prediction band')
+            ax.plot(px, upb, 'k--')
+
+            # -- style graph --
+            pred_max_pool = (nom+1.96*std)[-1]
+            pool_total = pool[-1]
+            entrants = (raffle_data.entries.entrants[-1]
+                        if raffle_data.entries.entrants.size > 0 else 0)
+            ax.set_ylim(0, max(pred_max_pool, pool_total))
+            ax.set_xlim((pd.to_datetime(raffle_data.start_date),
+                         pd.to_datetime(raffle_data.end_date)))
+
+            ax.set_title(str(remove_emojis(chat_title).strip()) + "\n" +
+                         f"Entries {entrants} | Pool {int_price_to_str(pool_total)} €")
+
+        return save_plot(fig, ax, 'graph')
+
+
+def generate_expected(raffle_data: RaffleData, chat_title: str) -> bytes:
+    # -- parse and fit data --
+    with render_stage('parse'):
+        x, next_expected = parse_expected(raffle_data)
+
+    # -- plot --
+    with figure_template('expected') as (fig, ax):
+        with render_stage('plot'):
+            ax.plot(*downsample(fig, x, next_expected), 'r', marker='o',
+                    label='Expected Value')
+
+            # -- style graph --
+            ax.set_ylim(float(int_price_to_str((next_expected.min() - 100) * 110)),
+                        float(int_price_to_str((next_expected.max() + 100) * 110)))
+            ax.set_xlim((pd.to_datetime(raffle_data.start_date),
+                         pd.to_datetime(get_cur_time_hel())))
+
+            ax.set_title(str(remove_emojis(chat_title).strip()) +
+                         f' | Fee {int_price_to_str(raffle_data.entry_fee)} €\n' +
+                         f"Expected Value { int_price_to_str(next_expected[-1])} €")
+
+        return save_plot(fig, ax, 'expected')
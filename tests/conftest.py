@@ -0,0 +1,40 @@
+import asyncio
+import inspect
+import pytest
+from kipubot import DATABASE_URL
+from kipubot.db import close_pool, open_pool
+
+
+@pytest.fixture
+def event_loop():
+    """Event loop the async test and its fixtures run in."""
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.run_until_complete(loop.shutdown_asyncgens())
+    loop.close()
+
+
+@pytest.fixture
+def db_pool(event_loop):  # pylint: disable=redefined-outer-name
+    """DB pool for the test, the first open also creates any missing tables."""
+    event_loop.run_until_complete(open_pool(DATABASE_URL))
+    yield
+    event_loop.run_until_complete(close_pool())
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_pyfunc_call(pyfuncitem):
+    # async tests are run in the loop of their fixtures, or in one of their own
+    if not inspect.iscoroutinefunction(pyfuncitem.obj):
+        return None
+
+    kwargs = {name: pyfuncitem.funcargs[name]
+              for name in pyfuncitem._fixtureinfo.argnames}  # pylint: disable=protected-access
+    coro = pyfuncitem.obj(**kwargs)
+
+    if 'event_loop' in pyfuncitem.funcargs:
+        pyfuncitem.funcargs['event_loop'].run_until_complete(coro)
+    else:
+        asyncio.run(coro)
+
+    return True
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+import asyncio
+import pytest
+from kipubot.cache import MISSING, RenderCache, TTLCache
+
+
+class TestRenderCache:
+
+    def test_hit_and_invalidate(self):
+        cache = RenderCache(max_bytes=100, bucket_seconds=60)
+        key = cache.key(1, 'graph')
+        cache.put(key, b'img')
+
+        assert cache.get(cache.key(1, 'graph')) == b'img'
+        assert cache.get(cache.key(1, 'expected')) is None
+        assert cache.get(cache.key(2, 'graph')) is None
+
+        cache.invalidate(1)
+
+        assert cache.key(1, 'graph') != key
+        assert cache.get(key) is None
+        assert cache.size == 0
+
+    def test_lru_eviction(self):
+        cache = RenderCache(max_bytes=10, bucket_seconds=60)
+        keys = [cache.key(chat_id, 'graph') for chat_id in range(3)]
+        cache.put(keys[0], b'aaaa')
+        cache.put(keys[1], b'bbbb')
+        # touch the first entry so the second one is the oldest
+        cache.get(keys[0])
+        cache.put(keys[2], b'cccc')
+
+        assert cache.get(keys[0]) == b'aaaa'
+        assert cache.get(keys[1]) is None
+        assert cache.get(keys[2]) == b'cccc'
+        assert cache.size == 8
+
+    def test_oversized_not_cached(self):
+        cache = RenderCache(max_bytes=2, bucket_seconds=60)
+        key = cache.key(1, 'graph')
+        cache.put(key, b'too big')
+
+        assert cache.get(key) is None
+        assert len(cache) == 0
+
+    def test_new_render_replaces_old_bucket(self):
+        cache = RenderCache(max_bytes=100, bucket_seconds=60)
+        cache.put((1, 'graph', 0, 1), b'old')
+        cache.put((1, 'graph', 0, 2), b'new')
+
+        assert cache.get((1, 'graph', 0, 1)) is None
+        assert cache.get((1, 'graph', 0, 2)) == b'new'
+        assert cache.size == 3
+
+    def test_file_ids(self):
+        cache = RenderCache(max_bytes=100, bucket_seconds=60)
+        cache.put_file_id((1, 'graph', 0, 1), 'old')
+        cache.put_file_id((1, 'graph', 0, 2), 'new')
+        cache.put_file_id((1, 'expected', 0, 2), 'expected')
+
+        assert cache.get_file_id((1, 'graph', 0, 1)) is None
+        assert cache.get_file_id((1, 'graph', 0, 2)) == 'new'
+
+        cache.forget_file_id((1, 'graph', 0, 2))
+        assert cache.get_file_id((1, 'graph', 0, 2)) is None
+
+        cache.invalidate(1)
+        assert cache.get_file_id((1, 'expected', 0, 2)) is None
+
+    async def test_concurrent_misses_share_a_render(self):
+        cache = RenderCache(max_bytes=100, bucket_seconds=60)
+        key = cache.key(1, 'graph')
+        renders = []
+
+        async def render():
+            renders.append(key)
+            await asyncio.sleep(0.01)
+            return b'img'
+
+        async def fail():
+            renders.append(key)
+            await asyncio.sleep(0.01)
+            raise ValueError
+
+        results = await asyncio.gather(*(cache.get_or_render(key, fail) for _ in range(3)),
+                                       return_exceptions=True)
+        assert len(renders) == 1
+        assert all(isinstance(result, ValueError) for result in results)
+
+        # a failed render isn't waited for again
+        results = await asyncio.gather(*(cache.get_or_render(key, render) for _ in range(3)))
+        assert len(renders) == 2
+        assert results == [b'img'] * 3
+        assert await cache.get_or_render(key, fail) == b'img'
+
+        with pytest.raises(ValueError):
+            await cache.get_or_render(cache.key(2, 'graph'), fail)
+
+
+class TestTTLCache:
+
+    def test_expiry_and_negative_entries(self):
+        now = [0.0]
+        cache = TTLCache(max_size=10, ttl=10, clock=lambda: now[0])
+        cache.put('member', 'alice')
+        cache.put('missing', None, ttl=1)
+
+        assert cache.get('member') == 'alice'
+        assert cache.get('missing') is None
+        assert cache.get('other') is MISSING
+
+        now[0] = 5
+        assert cache.get('member') == 'alice'
+        assert cache.get('missing') is MISSING
+
+        now[0] = 10
+        assert cache.get('member') is MISSING
+        assert len(cache) == 0
+
+    def test_lru_eviction(self):
+        cache = TTLCache(max_size=2, ttl=60)
+        cache.put(1, 'a')
+        cache.put(2, 'b')
+        # touch the first entry so the second one is the oldest
+        cache.get(1)
+        cache.put(3, 'c')
+
+        assert cache.get(2) is MISSING
+        assert cache.get(1) == 'a'
+        assert cache.get(3) == 'c'
+
+        cache.invalidate(1)
+        assert cache.get(1) is MISSING
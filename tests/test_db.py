@@ -0,0 +1,163 @@
+import asyncio
+from datetime import datetime
+import psycopg
+import pytest
+from kipubot import DATABASE_URL
+from kipubot.cache import chat_state_cache
+from kipubot.db import (ChatState, admin_cycle_winners, cycle_winners, delete_chat,
+                        delete_raffle_data, get_chat_state, get_raffle_history,
+                        get_registered_member_id, register_user, replace_cur_winner,
+                        save_chat_or_ignore, save_raffle_data, save_usernames, _init_db)
+from kipubot.utils import get_raffle, read_excel_to_df
+from kipubot.errors import AlreadyRegisteredError
+
+
+@pytest.mark.usefixtures('db_pool')
+class TestUsernameIndex:
+
+    async def test_username_lookup(self):
+        await save_chat_or_ignore(1, "testing", [1])
+
+        try:
+            await register_user(1, 101, 'Alice')
+            await save_usernames([(102, 'bob')])
+
+            assert await get_registered_member_id(1, 'alice') == 101
+            # known username, but not registered in the chat
+            assert await get_registered_member_id(1, 'bob') is None
+
+            # username changes are picked up on registering again
+            with pytest.raises(AlreadyRegisteredError):
+                await register_user(1, 101, 'alice_2')
+            assert await get_registered_member_id(1, 'alice') is None
+            assert await get_registered_member_id(1, 'alice_2') == 101
+
+            # a username taken over by another user moves with it
+            await register_user(1, 102, 'bob')
+            await save_usernames([(102, 'alice_2')])
+            assert await get_registered_member_id(1, 'alice_2') == 102
+        finally:
+            await save_usernames([(101, None), (102, None)])
+            await delete_chat(1)
+
+    async def test_batched_registrations(self):
+        await save_chat_or_ignore(1, "testing", [1])
+
+        try:
+            # registrations made together are written in one batch
+            results = await asyncio.gather(register_user(1, 101, 'alice'),
+                                           register_user(1, 101, 'alice'),
+                                           register_user(1, 102, 'bob'),
+                                           register_user(1, 102, 'Alice'),
+                                           return_exceptions=True)
+
+            assert results[0] is None and results[2] is None
+            assert isinstance(results[1], AlreadyRegisteredError)
+            assert isinstance(results[3], AlreadyRegisteredError)
+            # the username went to whoever registered with it last
+            assert await get_registered_member_id(1, 'alice') == 102
+            assert await get_registered_member_id(1, 'bob') is None
+
+            # a registration in a chat that doesn't exist fails alone
+            results = await asyncio.gather(register_user(2, 103, 'carol'),
+                                           register_user(1, 104),
+                                           return_exceptions=True)
+
+            assert isinstance(results[0], psycopg.errors.ForeignKeyViolation)
+            assert results[1] is None
+        finally:
+            await save_usernames([(101, None), (102, None)])
+            await delete_chat(1)
+
+
+@pytest.mark.usefixtures('db_pool')
+class TestChatState:
+
+    async def test_winner_updates(self):
+        await save_chat_or_ignore(1, "testing", [1])
+
+        try:
+            assert await get_chat_state(1) == ChatState([1], [], None)
+
+            await admin_cycle_winners(2, 1)
+            await cycle_winners(2, 3, 1)
+            await replace_cur_winner(4, 1)
+            cached = await get_chat_state(1)
+
+            chat_state_cache.clear()
+            assert await get_chat_state(1) == cached == ChatState([1], [None, 2], 4)
+            assert await get_chat_state(2) is None
+        finally:
+            await delete_chat(1)
+
+
+@pytest.mark.usefixtures('db_pool')
+class TestRaffleHistory:
+
+    async def test_new_raffle_archives_old(self):
+        await save_chat_or_ignore(1, "testing", [1])
+
+        start_date = datetime.fromisoformat("2022-08-01 03:15:00")
+        end_date = datetime.fromisoformat("2022-08-12 03:15:00")
+        df = read_excel_to_df("tests/example_data/example_1.xlsx", start_date, end_date)
+
+        try:
+            await save_raffle_data(1, start_date, end_date, 100, df)
+            await save_raffle_data(1, end_date, end_date, 100, df.iloc[:5])
+
+            history = await get_raffle_history(1)
+            raffle_data = await get_raffle(1, include_entries=True)
+
+            with psycopg.connect(DATABASE_URL) as con:
+                (archived,) = con.execute('''SELECT count(*) FROM raffle_entry_archive
+                                            WHERE raffle_id IN (SELECT raffle_id
+                                                FROM raffle_history WHERE chat_id = 1)'''
+                                          ).fetchone()
+
+            await delete_raffle_data(1)
+            history_after_delete = await get_raffle_history(1)
+        finally:
+            await delete_chat(1)
+
+        assert history == [(start_date, end_date, 100, len(df),
+                            df['name'].nunique(), df['amount'].sum())]
+        assert archived == len(df)
+        # only the new raffle's entries are left in the live table
+        assert len(raffle_data.entries.dates) == 5
+        assert history_after_delete == []
+
+    async def test_derived_series_migration(self):
+        await save_chat_or_ignore(1, "testing", [1])
+
+        start_date = datetime.fromisoformat("2022-08-01 03:15:00")
+        end_date = datetime.fromisoformat("2022-08-12 03:15:00")
+        df = read_excel_to_df("tests/example_data/example_1.xlsx", start_date, end_date)
+
+        try:
+            await save_raffle_data(1, start_date, end_date, 100, df)
+            saved = await get_raffle(1, include_entries=True)
+
+            # entries saved before the series were stored
+            with psycopg.connect(DATABASE_URL) as con:
+                con.execute('''ALTER TABLE raffle_entry
+                                ALTER COLUMN pool DROP NOT NULL,
+                                ALTER COLUMN entrants DROP NOT NULL,
+                                ALTER COLUMN win_odds DROP NOT NULL,
+                                ALTER COLUMN next_expected DROP NOT NULL''')
+                con.execute('''UPDATE raffle_entry
+                                SET pool = NULL, entrants = NULL,
+                                    win_odds = NULL, next_expected = NULL''')
+            _init_db(DATABASE_URL)
+
+            migrated = await get_raffle(1, include_entries=True)
+            with psycopg.connect(DATABASE_URL) as con:
+                nullable = con.execute('''SELECT is_nullable FROM information_schema.columns
+                                            WHERE table_name = 'raffle_entry'
+                                                AND column_name = 'pool' ''').fetchone()
+        finally:
+            await delete_raffle_data(1)
+            await delete_chat(1)
+
+        for saved_column, migrated_column in zip(saved.entries, migrated.entries):
+            assert (saved_column == migrated_column).all()
+        assert nullable == ('NO',)
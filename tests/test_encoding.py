@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+
+from io import BytesIO
+import pytest
+from PIL import Image
+from kipubot.encoding import ImageFormat, encode, image_format
+from kipubot.utils import new_plot
+
+
+@pytest.fixture(name='fig')
+def fixture_fig():
+    fig, ax = new_plot((4, 3), 50)
+    ax.plot([0, 1, 2], [0, 2, 1], 'r', label='line')
+    ax.legend()
+    return fig
+
+
+class TestEncoding:
+
+    def test_formats(self, fig):
+        for fmt in ('png', 'jpeg', 'webp'):
+            img = Image.open(BytesIO(encode(fig, ImageFormat(format=fmt))))
+
+            assert img.format == fmt.upper()
+            assert img.size == (200, 150)
+
+    def test_palette(self, fig):
+        img = Image.open(BytesIO(encode(fig, ImageFormat(colors=16))))
+
+        assert img.mode == 'P'
+        assert len(img.getcolors()) <= 16
+
+    def test_settings_per_graph_type(self, monkeypatch):
+        monkeypatch.setenv('GRAPH_FORMAT', 'webp')
+        monkeypatch.setenv('GRAPH_DPI', '72')
+        monkeypatch.setenv('GRAPH_FORMAT_EXPECTED', 'jpg')
+        monkeypatch.setenv('GRAPH_SIZE_EXPECTED', '8x4.5')
+
+        assert image_format('graph') == ImageFormat(format='webp', dpi=72)
+        assert image_format('expected') == ImageFormat(format='jpeg', dpi=72, size=(8, 4.5))
+
+        monkeypatch.setenv('GRAPH_FORMAT', 'gif')
+        with pytest.raises(ValueError):
+            image_format('graph')
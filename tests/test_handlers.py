@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+import json
+import asyncio
+from types import SimpleNamespace
+import pytest
+from telegram import Update
+from telegram.ext import ApplicationBuilder
+from telegram.request import BaseRequest
+from kipubot import db
+from kipubot.db import delete_chat, save_chat_or_ignore
+from kipubot.handlers import moro_handler
+from kipubot.handlers._excel_file_handler import forget_raffle_entries
+
+UPDATE_PATH = 'tests/example_data/updates/moro.json'
+BOT_USER = {'id': 123456, 'is_bot': True, 'first_name': 'Kipubot', 'username': 'kipubot'}
+
+
+class RecordingRequest(BaseRequest):
+    """Answers Bot API calls without Telegram, recording the messages sent."""
+
+    def __init__(self) -> None:
+        self.sent = []
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url, method, request_data=None, **_kwargs):
+        if url.endswith('/getMe'):
+            result = BOT_USER
+        else:
+            params = request_data.parameters
+            self.sent.append(params['text'])
+            result = {'message_id': len(self.sent), 'date': 0, 'text': params['text'],
+                      'chat': {'id': params['chat_id'], 'type': 'supergroup'}}
+
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+
+@pytest.mark.usefixtures('db_pool')
+class TestMoroHandler:
+
+    async def test_moros_are_batched(self, monkeypatch):
+        batches = []
+        register_batch = db._register_batch  # pylint: disable=protected-access
+
+        async def recording_register_batch(batch):
+            batches.append(len(batch))
+            return await register_batch(batch)
+
+        monkeypatch.setattr(db, '_register_batch', recording_register_batch)
+        monkeypatch.setattr(db, 'registrations', db.RegistrationBatcher(100, 0.05))
+
+        request = RecordingRequest()
+        app = ApplicationBuilder().token('123456:test').request(request).build()
+        app.add_handler(moro_handler)
+
+        with open(UPDATE_PATH, encoding='utf-8') as f:
+            data = json.load(f)
+        chat_id = data['message']['chat']['id']
+
+        await save_chat_or_ignore(chat_id, 'Kipubot testing', [])
+
+        try:
+            async with app:
+                await app.start()
+                # updates are processed one after another, like the bot does
+                for user_id in (201, 202, 203):
+                    data['message']['from']['id'] = user_id
+                    await app.process_update(Update.de_json(data, app.bot))
+                # waits for the handlers still running
+                await app.stop()
+        finally:
+            await delete_chat(chat_id)
+
+        assert batches == [3]
+        assert len(request.sent) == 3
+
+
+class TestExcelFileHandler:
+
+    def test_unused_entries_are_forgotten(self):
+        context = SimpleNamespace(user_data={'raffle_entries': object()})
+        asyncio.run(forget_raffle_entries(context))
+        assert context.user_data == {}
+
+    def test_entries_are_kept_during_setup(self):
+        user_data = {'raffle_entries': object(), 'raffle_chat_id': -100}
+        asyncio.run(forget_raffle_entries(SimpleNamespace(user_data=user_data)))
+        assert 'raffle_entries' in user_data
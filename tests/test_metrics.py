@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+import asyncio
+import pytest
+from prometheus_client import REGISTRY
+from telegram.ext import CallbackQueryHandler, ConversationHandler
+from kipubot.metrics import instrument
+from kipubot.render import _render_timed, render_stage
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+class TestMetrics:
+
+    def test_instrument_conversation(self):
+        async def ok(_update, _context):
+            return 'next'
+
+        async def fail(_update, _context):
+            raise ValueError
+
+        handler = instrument(ConversationHandler(
+            entry_points=[CallbackQueryHandler(ok)],
+            states={'test_state:pick': [CallbackQueryHandler(fail)]},
+            fallbacks=[]), 'test')
+        entry, state = handler.entry_points[0], handler.states['test_state:pick'][0]
+
+        before = sample('kipubot_handler_calls_total', handler='test:entry')
+        assert asyncio.run(entry.callback(None, None)) == 'next'
+        assert sample('kipubot_handler_calls_total', handler='test:entry') == before + 1
+
+        errors = sample('kipubot_handler_errors_total', handler='test:pick')
+        with pytest.raises(ValueError):
+            asyncio.run(state.callback(None, None))
+        assert sample('kipubot_handler_errors_total', handler='test:pick') == errors + 1
+
+    def test_render_stages(self):
+        def render_func():
+            with render_stage('parse'):
+                pass
+            with render_stage('encode'):
+                return b'img'
+
+        img, stages = _render_timed(render_func)
+
+        assert img == b'img'
+        assert set(stages) == {'parse', 'encode'}
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+import asyncio
+import psycopg
+import pytest
+import pandas as pd
+from kipubot import DATABASE_URL
+from kipubot import db
+from kipubot import persistence as persistence_module
+from kipubot.db import get_registered_member_id
+from kipubot.persistence import PostgresPersistence
+
+
+@pytest.mark.usefixtures('db_pool')
+class TestPostgresPersistence:
+
+    async def test_user_data_round_trip(self):
+        persistence = PostgresPersistence(DATABASE_URL)
+        user_data = {'raffle_chat_id': 1,
+                     'raffle_start_date': pd.Timestamp('2022-08-01 03:15'),
+                     'raffle_entries': pd.DataFrame({'amount': [100, 200]})}
+
+        try:
+            assert await persistence.get_user_data() == {}
+            await persistence.update_user_data(1, user_data)
+
+            # a fresh process loads the data when the user is first seen
+            loaded = {}
+            await PostgresPersistence(DATABASE_URL).refresh_user_data(1, loaded)
+            assert loaded['raffle_start_date'] == user_data['raffle_start_date']
+            assert loaded['raffle_entries'].equals(user_data['raffle_entries'])
+
+            await persistence.drop_user_data(1)
+            dropped = {}
+            await PostgresPersistence(DATABASE_URL).refresh_user_data(1, dropped)
+            assert dropped == {}
+        finally:
+            await persistence.drop_user_data(1)
+
+    async def test_only_changed_data_is_written(self):
+        persistence = PostgresPersistence(DATABASE_URL)
+        assert not persistence.store_data.chat_data
+
+        def stored():
+            with psycopg.connect(DATABASE_URL) as con:
+                return [row[0] for row in con.execute(
+                    "SELECT data FROM persistence_data WHERE kind = 'user' AND id = 1")]
+
+        try:
+            assert await persistence.get_user_data() == {}
+            user_data = {}
+            await persistence.refresh_user_data(1, user_data)
+            # users without data have no row
+            await persistence.update_user_data(1, user_data)
+            assert stored() == []
+
+            user_data['raffle_chat_id'] = 1
+            await persistence.update_user_data(1, user_data)
+            with psycopg.connect(DATABASE_URL) as con:
+                con.execute("UPDATE persistence_data SET data = 'other' WHERE kind = 'user' AND id = 1")
+
+            # unchanged data isn't written again
+            await persistence.update_user_data(1, user_data)
+            assert stored() == [b'other']
+
+            user_data.clear()
+            await persistence.update_user_data(1, user_data)
+            assert stored() == []
+
+            # chat data isn't stored at all
+            await persistence.update_chat_data(1, {'key': 'value'})
+            with psycopg.connect(DATABASE_URL) as con:
+                assert con.execute("SELECT count(*) FROM persistence_data "
+                                   "WHERE kind = 'chat'").fetchone() == (0,)
+        finally:
+            await persistence.drop_user_data(1)
+
+    async def test_remembered_users_are_bounded(self, monkeypatch):
+        monkeypatch.setattr(persistence_module, 'PERSISTENCE_CACHE_MAX_SIZE', 2)
+        persistence = PostgresPersistence(DATABASE_URL)
+
+        try:
+            for user_id in (1, 2, 3):
+                await persistence.update_user_data(user_id, {'user': user_id})
+            assert len(persistence._digests) == 2  # pylint: disable=protected-access
+
+            # an evicted user's data in memory isn't replaced by the stored data
+            user_data = {'user': 'changed'}
+            await persistence.refresh_user_data(1, user_data)
+            assert user_data == {'user': 'changed'}
+        finally:
+            for user_id in (1, 2, 3):
+                await persistence.drop_user_data(user_id)
+
+    async def test_conversations(self):
+        persistence = PostgresPersistence(DATABASE_URL)
+
+        try:
+            assert await persistence.get_conversations('testing') == {}
+            await persistence.update_conversation('testing', (1, 2), 'state')
+            await persistence.update_conversation('testing', (1, 3), 'state')
+            await persistence.update_conversation('testing', (1, 3), None)
+
+            assert await persistence.get_conversations('testing') == {(1, 2): 'state'}
+        finally:
+            await persistence.update_conversation('testing', (1, 2), None)
+
+    async def test_flush_writes_queued_registrations(self, monkeypatch):
+        monkeypatch.setattr(db, 'registrations', db.RegistrationBatcher(100, 60))
+        persistence = PostgresPersistence(DATABASE_URL)
+        await db.save_chat_or_ignore(1, 'testing', [])
+
+        try:
+            registering = asyncio.ensure_future(db.register_user(1, 301, 'queued'))
+            await asyncio.sleep(0)
+            # the application flushes the persistence when it stops
+            await persistence.flush()
+            await registering
+
+            await db.open_pool(DATABASE_URL)
+            assert await get_registered_member_id(1, 'queued') == 301
+        finally:
+            await db.save_usernames([(301, None)])
+            await db.delete_chat(1)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+import logging
+from datetime import datetime
+import pytest
+from kipubot import profiling
+from kipubot.cache import chat_state_cache
+from kipubot.db import (ChatState, admin_cycle_winners, delete_chat,
+                        delete_raffle_data, get_chat_state, get_raffle_data,
+                        save_chat_or_ignore, save_raffle_data)
+from kipubot.utils import read_excel_to_df
+
+
+# the pool is opened once the profiling is on
+@pytest.mark.usefixtures('profile', 'db_pool')
+class TestProfiling:
+
+    @pytest.fixture
+    def profile(self, monkeypatch):
+        monkeypatch.setattr(profiling, 'DB_PROFILE', True)
+        # explain every query
+        monkeypatch.setattr(profiling, 'DB_SLOW_QUERY_MS', 0)
+        profiling.reset()
+        yield
+        profiling.reset()
+
+    async def test_profile(self, caplog):
+        try:
+            await save_chat_or_ignore(1, "testing", [1])
+            with caplog.at_level(logging.WARNING, logger='kipubot.profiling'):
+                await admin_cycle_winners(2, 1)
+            # the explained update was rolled back, so it was applied once
+            chat_state_cache.clear()
+            assert await get_chat_state(1) == ChatState([1], [None], 2)
+        finally:
+            await delete_chat(1)
+
+        assert 'Slow query in admin_cycle_winners' in caplog.text
+        assert 'Update on chat' in caplog.text
+
+        stats = profiling._stats['admin_cycle_winners']  # pylint: disable=protected-access
+        assert (stats.calls, stats.queries, stats.rows) == (1, 1, 1)
+        assert 'admin_cycle_winners' in profiling.report()
+
+    async def test_cursor_queries(self):
+        start_date = datetime.fromisoformat("2022-08-01 03:15:00")
+        end_date = datetime.fromisoformat("2022-08-12 03:15:00")
+        df = read_excel_to_df("tests/example_data/example_1.xlsx", start_date, end_date)
+
+        try:
+            await save_chat_or_ignore(1, "testing", [1])
+            await delete_raffle_data(1)
+            profiling.reset()
+            await save_raffle_data(1, start_date, end_date, 100, df)
+            await get_raffle_data(1)
+        finally:
+            await delete_raffle_data(1)
+            await delete_chat(1)
+
+        # the COPY of the entries counts the rows it wrote
+        saved = profiling._stats['save_raffle_data']  # pylint: disable=protected-access
+        assert saved.rows >= len(df)
+        # the entries are read with a binary cursor of their own
+        stats = profiling._stats['get_raffle_data']  # pylint: disable=protected-access
+        assert (stats.calls, stats.queries, stats.rows) == (1, 2, 2)
@@ -0,0 +1,24 @@
+import numpy as np
+from kipubot.raffle import lttb
+
+
+class TestLttb:
+
+    def test_short_series_kept(self):
+        x = np.arange(10)
+        assert (lttb(x, x, 10) == x).all()
+        assert (lttb(x, x, 20) == x).all()
+
+    def test_downsampled(self):
+        rng = np.random.default_rng(0)
+        x = np.sort(rng.integers(0, 10**15, size=100_000))
+        y = np.cumsum(rng.integers(1, 5, size=100_000))
+        # a spike in the middle of the series
+        y[50_000] += 10**6
+
+        kept = lttb(x, y, 500)
+
+        assert kept.size == 500
+        assert (np.diff(kept) > 0).all()
+        assert kept[0] == 0 and kept[-1] == x.size - 1
+        assert 50_000 in kept
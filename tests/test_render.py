@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+import time
+import asyncio
+import pytest
+from kipubot import render
+
+
+def slow_render():
+    time.sleep(60)
+    return b'slow'
+
+
+def fast_render():
+    return b'fast'
+
+
+class TestRender:
+
+    def test_timeout_stops_stuck_workers(self, monkeypatch):
+        monkeypatch.setattr(render, 'RENDER_EXECUTOR', 'process')
+        monkeypatch.setattr(render, 'RENDER_WORKERS', 1)
+        monkeypatch.setattr(render, 'RENDER_TIMEOUT', 5)
+        render.shutdown_executor()
+
+        try:
+            # the first render starts the worker
+            assert asyncio.run(render.render(fast_render))[0] == b'fast'
+            executor = render.get_executor()
+            workers = list(executor._processes.values())  # pylint: disable=protected-access
+
+            monkeypatch.setattr(render, 'RENDER_TIMEOUT', 0.5)
+            with pytest.raises(asyncio.TimeoutError):
+                asyncio.run(render.render(slow_render))
+
+            for worker in workers:
+                worker.join(timeout=5)
+                assert not worker.is_alive()
+
+            monkeypatch.setattr(render, 'RENDER_TIMEOUT', 5)
+            assert render.get_executor() is not executor
+            assert asyncio.run(render.render(fast_render))[0] == b'fast'
+        finally:
+            render.shutdown_executor()
+
+    def test_timeout_keeps_thread_pool(self, monkeypatch):
+        monkeypatch.setattr(render, 'RENDER_EXECUTOR', 'thread')
+        monkeypatch.setattr(render, 'RENDER_TIMEOUT', 0.01)
+        render.shutdown_executor()
+
+        def sleep_render():
+            time.sleep(0.1)
+            return b'img'
+
+        try:
+            executor = render.get_executor()
+            with pytest.raises(asyncio.TimeoutError):
+                asyncio.run(render.render(sleep_render))
+            assert render.get_executor() is executor
+        finally:
+            render.shutdown_executor()
@@ -0,0 +1,10 @@
+#!/usr/bin/env python3
+
+from benchmarks.bench_startup import measure
+
+
+class TestStartup:
+
+    def test_no_heavy_imports(self):
+        # analytics libraries are only loaded when a graph or raffle needs them
+        assert measure('kipubot.bot')['heavy'] == []
@@ -1,11 +1,18 @@
 #!/usr/bin/env python3
 
+from io import BytesIO
 import pytest
+from openpyxl import Workbook
+import pandas as pd
 from datetime import datetime
-from db import delete_chat, delete_raffle_data, save_chat_or_ignore, _init_db
-from kipubot import DATABASE_URL
-from pandas.testing import assert_frame_equal
-from kipubot.utils import get_raffle, int_price_to_str, remove_emojis, read_excel_to_df, save_raffle
+from benchmarks.bench_regression import legacy_fit_timedata, max_rel_diff, synthetic_series
+from kipubot.db import delete_chat, delete_raffle_data, get_raffle_entries, save_chat_or_ignore
+from numpy.testing import assert_array_equal
+from concurrent.futures import ThreadPoolExecutor
+from kipubot.raffle import RaffleEntries, entries_from_df
+from kipubot.utils import (RaffleData, append_raffle, clear_figure_templates, fit_timedata,
+                           generate_expected, generate_graph, get_raffle, int_price_to_str,
+                           parse_excel, remove_emojis, read_excel_to_df, save_raffle)
 
 
 class TestUtils:
@@ -37,29 +44,143 @@ class TestUtils:
         assert remove_emojis(
             '💩text with emoji💩at the start, middle and end💩') == ' text with emoji at the start, middle and end '
 
+    def test_parse_excel(self):
+        def to_excel(rows):
+            wb = Workbook()
+            for row in rows:
+                wb.active.append(row)
+            excel_file = BytesIO()
+            wb.save(excel_file)
+            excel_file.seek(0)
+            return excel_file
+
+        date = datetime.fromisoformat("2022-08-02 12:00:00")
+        df = parse_excel(to_excel([(date, 'a', 'msg', 1.5),
+                                   (date, 'b', 'msg', 0),
+                                   (date, 'c', 'msg', 2)]))
+
+        assert df['name'].tolist() == ['a', 'c']
+        assert df['amount'].tolist() == [150, 200]
+        assert df['date'].tolist() == [date, date]
+
+        assert parse_excel(to_excel([('Date', 'Name', 'Message', 'Amount'),
+                                     (date, 'a', 'msg', 1)])) is None
+        assert parse_excel(to_excel([])) is None
+        assert parse_excel(BytesIO(b'not an excel file')) is None
+
+
+class TestFitTimedata:
+
+    def test_matches_legacy_fit(self):
+        # curve_fit on raw nanosecond timestamps is only accurate to about 1e-4
+        for n in (10, 1000):
+            x_series, y_series = synthetic_series(n)
+            # the legacy fit is evaluated at one point per entry
+            px, *lines = fit_timedata(x_series, y_series, grid_size=n)
+            legacy_px, *legacy_lines = legacy_fit_timedata(x_series, y_series)
+
+            assert (px == pd.to_datetime(legacy_px)).all()
+            for line, legacy_line in zip(lines, legacy_lines):
+                assert max_rel_diff(line, legacy_line) < 1e-3
+
+
+@pytest.mark.usefixtures('db_pool')
 class TestGraphSave:
-        
-    @pytest.fixture(autouse=True)
-    def create_chat(self):
-        _init_db(DATABASE_URL)
-        save_chat_or_ignore(1, "testing", [1])
-        yield 1
-        delete_chat(1)
 
+    async def test_graph_save(self):
+        await save_chat_or_ignore(1, "testing", [1])
+
+        try:
+            file_path = "tests/example_data/example_1.xlsx"
+            start_date = datetime.fromisoformat("2022-08-01 03:15:00")
+            end_date = datetime.fromisoformat("2022-08-12 03:15:00")
+            entry_fee = 1
+            df = read_excel_to_df(file_path, start_date, end_date)
+            await save_raffle(1, start_date, end_date, entry_fee, df)
+            raffle_from_db = await get_raffle(1, include_entries=True)
+            await delete_raffle_data(1)
+        finally:
+            await delete_chat(1)
 
-    def test_graph_save(self):
-        file_path = "tests/example_data/example_1.xlsx"
-        start_date = datetime.fromisoformat("2022-08-01 03:15:00")
-        end_date = datetime.fromisoformat("2022-08-12 03:15:00")
-        entry_fee = 1
-        df = read_excel_to_df(file_path, start_date, end_date)
-        save_raffle(1, start_date, end_date, entry_fee, df)
-        raffle_from_db = get_raffle(1, True)
-        delete_raffle_data(1)
         assert (start_date == raffle_from_db.start_date)
         assert (end_date == raffle_from_db.end_date)
         assert (entry_fee == raffle_from_db.entry_fee)
 
-        # behavior that get_raffle returns without index and read returns with probably should be changed.
-        df.set_index('date',inplace=True)
-        assert_frame_equal(df,raffle_from_db.df)
+        # entries are returned in date order, with the series derived when they were saved
+        for column, stored in zip(entries_from_df(df, entry_fee), raffle_from_db.entries):
+            assert_array_equal(column, stored)
+
+    async def test_raffle_entries_range(self):
+        await save_chat_or_ignore(1, "testing", [1])
+
+        try:
+            start_date = datetime.fromisoformat("2022-08-01 03:15:00")
+            end_date = datetime.fromisoformat("2022-08-12 03:15:00")
+            df = read_excel_to_df("tests/example_data/example_1.xlsx", start_date, end_date)
+            await save_raffle(1, start_date, end_date, 1, df)
+            since = df['date'].sort_values().iloc[5]
+            entries = await get_raffle_entries(1, since=since)
+            await delete_raffle_data(1)
+        finally:
+            await delete_chat(1)
+
+        assert len(entries) == (df['date'] >= since).sum()
+        assert all(date >= since for date, _, _ in entries)
+
+    async def test_raffle_append(self):
+        await save_chat_or_ignore(1, "testing", [1])
+
+        try:
+            start_date = datetime.fromisoformat("2022-08-01 03:15:00")
+            end_date = datetime.fromisoformat("2022-08-12 03:15:00")
+            df = read_excel_to_df("tests/example_data/example_1.xlsx", start_date, end_date)
+            df = df.sort_values('date')
+            # the same entry twice in the same moment is two entries
+            df = pd.concat([df, df.iloc[[-1]]])
+            await save_raffle(1, start_date, end_date, 1, df.iloc[:10])
+            added = await append_raffle(1, df.sample(frac=1, random_state=1))
+            added_again = await append_raffle(1, df)
+            raffle_from_db = await get_raffle(1, include_entries=True)
+            await delete_raffle_data(1)
+        finally:
+            await delete_chat(1)
+
+        assert added == len(df) - 10
+        assert added_again == 0
+        assert len(raffle_from_db.entries.dates) == len(df)
+        # the derived series carry on from the stored entries
+        for column, stored in zip(entries_from_df(df, 1), raffle_from_db.entries):
+            assert_array_equal(column, stored)
+
+
+class TestGraphRender:
+
+    @pytest.fixture
+    def raffle_data(self):
+        start_date = datetime.fromisoformat("2022-08-01 03:15:00")
+        end_date = datetime.fromisoformat("2022-08-12 03:15:00")
+        df = read_excel_to_df("tests/example_data/example_1.xlsx", start_date, end_date)
+        return RaffleData(start_date, end_date, 100, entries_from_df(df, 100))
+
+    def test_render_in_threads(self, raffle_data):
+        renders = [(generate_graph, raffle_data) for _ in range(2)]
+        renders += [(generate_expected, raffle_data) for _ in range(2)]
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            imgs = list(executor.map(lambda r: r[0](r[1], 'testing'), renders))
+
+        for img in imgs:
+            assert img.startswith(b'\x89PNG')
+
+    def test_reused_template_matches_fresh_figure(self, raffle_data):
+        clear_figure_templates()
+        fresh = generate_graph(raffle_data, 'testing')
+
+        # the template keeps nothing of the previous render
+        clear_figure_templates()
+        other = raffle_data._replace(
+            entries=RaffleEntries(*(column[::2] for column in raffle_data.entries)))
+        generate_graph(other, 'another chat')
+        reused = generate_graph(raffle_data, 'testing')
+
+        assert reused == fresh
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+import json
+import asyncio
+import httpx
+from telegram import Bot, Update, User
+from telegram.ext._utils.webhookhandler import WebhookAppClass, WebhookServer
+from kipubot.handlers import moro_handler
+
+UPDATE_PATH = 'tests/example_data/updates/moro.json'
+SECRET_TOKEN = 'secret'
+
+
+class TestWebhook:
+
+    async def test_post_recorded_update(self):
+        # the same server run_webhook starts, without registering it with Telegram
+        update_queue: asyncio.Queue = asyncio.Queue()
+        bot = Bot('123456:test')
+        # normally filled in by getMe when the application starts
+        bot._bot_user = User(123456, 'Kipubot', True, username='kipubot')  # pylint: disable=protected-access
+        server = WebhookServer('127.0.0.1', 0, WebhookAppClass(
+            '/telegram', bot, update_queue, SECRET_TOKEN), None)
+        await server.serve_forever()
+        # port 0 picks a free port
+        port = list(server._http_server._sockets.values())[0].getsockname()[1]  # pylint: disable=protected-access
+
+        with open(UPDATE_PATH, encoding='utf-8') as f:
+            body = f.read()
+
+        try:
+            async with httpx.AsyncClient() as client:
+                url = f'http://127.0.0.1:{port}/telegram'
+                headers = {'Content-Type': 'application/json'}
+                forbidden = await client.post(url, content=body, headers=headers)
+                headers['X-Telegram-Bot-Api-Secret-Token'] = SECRET_TOKEN
+                accepted = await client.post(url, content=body, headers=headers)
+        finally:
+            await server.shutdown()
+
+        assert forbidden.status_code == 403
+        assert accepted.status_code == 200
+
+        update = update_queue.get_nowait()
+        assert isinstance(update, Update)
+        assert update.update_id == json.loads(body)['update_id']
+        assert moro_handler.check_update(update)